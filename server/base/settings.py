@@ -46,6 +46,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     "authentication",
+    "rag",
     "rest_framework",
     "rest_framework_simplejwt",
     "dotenv",
@@ -153,3 +154,121 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = "authentication.User"
+
+
+# RAG pipeline
+
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-mpnet-base-v2")
+EMBEDDING_DEVICE = os.getenv("EMBEDDING_DEVICE", "cpu")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+# Warm-up only runs in gunicorn/uvicorn/daphne/hypercorn and runserver; set RAG_SERVING=true
+# to warm up under another server
+EMBEDDING_WARMUP = os.getenv("EMBEDDING_WARMUP", "true").lower() == "true"
+# Chunk embeddings are cached on disk by (model, text hash); 0 disables the cache
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", str(BASE_DIR / "cache" / "embeddings.sqlite3"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "500000"))
+
+# "cloud" uses Chroma Cloud with the api_key/tenant env vars, "persistent" keeps the
+# vectors on local disk and "memory" runs an in-process store (useful for benchmarks)
+CHROMA_BACKEND = os.getenv("CHROMA_BACKEND", "cloud")
+CHROMA_PERSIST_PATH = os.getenv("CHROMA_PERSIST_PATH", str(BASE_DIR / "chroma_data"))
+CHROMA_DATABASE = os.getenv("CHROMA_DATABASE", "Project")
+CHROMA_HEALTH_CHECK_INTERVAL = int(os.getenv("CHROMA_HEALTH_CHECK_INTERVAL", "30"))
+
+# "chroma" stores vectors through the Chroma client above; "local" keeps them on this node
+# in memory-mapped files with an IVF index (LOCAL_VECTOR_NLIST lists, LOCAL_VECTOR_NPROBE
+# searched per query, 0 lists = exact scan).
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+LOCAL_VECTOR_PATH = os.getenv("LOCAL_VECTOR_PATH", str(BASE_DIR / "vector_data"))
+# How the local backend stores vectors: float32, int8, binary, matryoshka:<dims> or
+# pca:<dims> (see utils/quantization.py). With rescoring the float32 vectors are kept on
+# disk as well, and the LOCAL_VECTOR_RESCORE_FACTOR * k best candidates are re-ranked
+# with them. `manage.py benchmark_embeddings` compares recall and memory of each.
+LOCAL_VECTOR_ENCODING = os.getenv("LOCAL_VECTOR_ENCODING", "float32")
+LOCAL_VECTOR_RESCORE = os.getenv("LOCAL_VECTOR_RESCORE", "true").lower() == "true"
+LOCAL_VECTOR_RESCORE_FACTOR = int(os.getenv("LOCAL_VECTOR_RESCORE_FACTOR", "4"))
+LOCAL_VECTOR_NLIST = int(os.getenv("LOCAL_VECTOR_NLIST", "256"))
+LOCAL_VECTOR_NPROBE = int(os.getenv("LOCAL_VECTOR_NPROBE", "16"))
+
+# Per-collection searches run concurrently; collections slower than the timeout are skipped
+RETRIEVAL_MAX_WORKERS = int(os.getenv("RETRIEVAL_MAX_WORKERS", "8"))
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "5"))
+# Minimum relevance (cosine similarity, whatever the collection's distance metric)
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.65"))
+# Upper bound for the per-request `k` of /rag/chat/ (the `threshold` is clamped to [0, 1])
+RETRIEVAL_MAX_K = int(os.getenv("RETRIEVAL_MAX_K", "20"))
+# Retrieved chunks are deduplicated, merged and cut to this many (estimated) prompt tokens
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+# Hybrid search: a BM25 index of the same chunks is queried next to the vectors and the
+# two rankings are merged with reciprocal rank fusion. Each side contributes its top
+# HYBRID_CANDIDATES; keyword hits are kept even below SIMILARITY_THRESHOLD.
+# Run `manage.py build_lexical_index` once to index collections ingested before this.
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", str(BASE_DIR / "cache" / "lexical.sqlite3"))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Optional cross-encoder rerank between retrieval and generation: RERANK_CANDIDATES chunks
+# are retrieved and the best k kept. Past RERANK_BUDGET_MS the vector order is used instead.
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "false").lower() == "true"
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "10"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+RERANK_BUDGET_MS = int(os.getenv("RERANK_BUDGET_MS", "300"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "10000"))
+RERANK_CACHE_TTL = int(os.getenv("RERANK_CACHE_TTL", "3600"))
+
+# "per_upload" creates a collection for every upload, "per_user" keeps one collection per
+# user and tells uploads apart by doc_id metadata. Run `manage.py consolidate_collections`
+# before switching an existing install to "per_user".
+VECTOR_LAYOUT = os.getenv("VECTOR_LAYOUT", "per_upload")
+
+# Uploads are ingested by a local background worker pool (see rag/jobs.py)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# Chunks embedded and upserted per batch; a crashed job resumes after its last committed batch
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+# Workers touch the updated_at of the jobs they hold every INGEST_HEARTBEAT_SECONDS;
+# resume_ingest_jobs only takes over jobs whose heartbeat is older than INGEST_LEASE_SECONDS
+INGEST_HEARTBEAT_SECONDS = int(os.getenv("INGEST_HEARTBEAT_SECONDS", "30"))
+INGEST_LEASE_SECONDS = int(os.getenv("INGEST_LEASE_SECONDS", "120"))
+# Uploaded files are parsed in a process pool (0 = one process per CPU)
+INGEST_PARSE_PROCESSES = int(os.getenv("INGEST_PARSE_PROCESSES", "0"))
+INGEST_MAX_ARCHIVE_MB = int(os.getenv("INGEST_MAX_ARCHIVE_MB", "1024"))
+# Uploads up to FILE_UPLOAD_MAX_MEMORY_SIZE (Django's 2.5 MB by default) are parsed from memory;
+# larger ones are spooled to disk by Django and PDFs at least INGEST_MMAP_THRESHOLD_MB big are
+# memory-mapped while parsed. In-memory uploads are written to disk only when their job has to
+# wait for a worker, so resume_ingest_jobs can not recover those of a job that was running
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv("FILE_UPLOAD_MAX_MEMORY_SIZE", str(2621440)))
+INGEST_MMAP_THRESHOLD_MB = int(os.getenv("INGEST_MMAP_THRESHOLD_MB", "8"))
+# MongoDB sources are streamed in batches from this many parallel _id ranges
+MONGO_BATCH_SIZE = int(os.getenv("MONGO_BATCH_SIZE", "1000"))
+MONGO_SHARDS = int(os.getenv("MONGO_SHARDS", "4"))
+# REST API sources
+API_TIMEOUT = float(os.getenv("API_TIMEOUT", "30"))
+API_RETRIES = int(os.getenv("API_RETRIES", "3"))
+API_CONCURRENCY = int(os.getenv("API_CONCURRENCY", "4"))
+API_MAX_PAGES = int(os.getenv("API_MAX_PAGES", "1000"))
+API_VALIDATOR_CACHE_PATH = os.getenv("API_VALIDATOR_CACHE_PATH", str(BASE_DIR / "cache" / "api_validators"))
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+# Compiled retrieval graphs are cached per user collection set
+RAG_APP_CACHE_SIZE = int(os.getenv("RAG_APP_CACHE_SIZE", "256"))
+
+# Answers are reused for the same or a near-identical question (cosine similarity of the
+# question embeddings >= threshold) with the same k/threshold until the user ingests again;
+# only first questions of a conversation are cached. Each process keeps its own entries, an
+# ingest retires them everywhere through CACHE_VERSIONS_PATH. 0 disables the cache
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+# Retrieval results are cached by (query, collections, collection version); 0 disables.
+# Versions are counters in CACHE_VERSIONS_PATH, so a write by any process on the node
+# (ingest jobs, management commands) retires the cached entries of every server process
+CACHE_VERSIONS_PATH = os.getenv("CACHE_VERSIONS_PATH", str(BASE_DIR / "cache" / "versions.sqlite3"))
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "2048"))
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", "600"))
+
+# Server-side chat sessions: turns beyond CHAT_SESSION_MAX_TURNS are folded into a rolling
+# summary, keeping the latest CHAT_SESSION_KEEP_TURNS verbatim. Every turn not yet folded
+# goes into the prompt, so CHAT_SESSION_MAX_TURNS also bounds the prompt's history
+CHAT_SESSION_MAX_TURNS = int(os.getenv("CHAT_SESSION_MAX_TURNS", "6"))
+CHAT_SESSION_KEEP_TURNS = int(os.getenv("CHAT_SESSION_KEEP_TURNS", "3"))
@@ -1,3 +1,13 @@
 from django.contrib import admin
+from .models import ChatSession, IngestJob
 
-# Register your models here.
+
+@admin.register(IngestJob)
+class IngestJobAdmin(admin.ModelAdmin):
+    list_display = ["id", "user", "source_type", "status", "stage", "processed_chunks", "total_chunks", "created_at"]
+    list_filter = ["status", "source_type"]
+
+
+@admin.register(ChatSession)
+class ChatSessionAdmin(admin.ModelAdmin):
+    list_display = ["id", "user", "updated_at"]
@@ -1,6 +1,44 @@
+import os
+import sys
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class RagConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'rag'
+
+    def ready(self):
+        if not settings.EMBEDDING_WARMUP or not _is_serving():
+            return
+
+        from utils.embeddings import warm_up_embeddings
+        from utils.rerank import get_reranker
+
+        # load in the background so the server starts accepting requests right away
+        threading.Thread(target=warm_up_embeddings, name="embedding-warmup", daemon=True).start()
+        if get_reranker() is not None:
+            # otherwise the first questions would all fall back to vector order while it loads
+            threading.Thread(target=get_reranker().warm_up, name="rerank-warmup", daemon=True).start()
+
+
+_SERVERS = {"gunicorn", "uvicorn", "daphne", "hypercorn"}
+
+
+def _is_serving():
+    """
+    True for the known app servers, the runserver child process, and any process
+    started with RAG_SERVING=true (for servers not in the list).
+    """
+    if os.environ.get("RAG_SERVING", "").lower() == "true":
+        return True
+    # "gunicorn ..." as well as "python -m uvicorn ..." (argv[0] is then uvicorn/__main__.py)
+    entry = os.path.normpath(sys.argv[0]).split(os.sep) if sys.argv and sys.argv[0] else []
+    if any(part in _SERVERS for part in entry[-2:]):
+        return True
+    if os.path.basename(sys.argv[0]).startswith("manage") and len(sys.argv) > 1 and sys.argv[1] == "runserver":
+        # the autoreloader parent only watches files, the child serves requests
+        return os.environ.get("RUN_MAIN") == "true" or "--noreload" in sys.argv
+    return False
@@ -0,0 +1,130 @@
+"""
+Async versions of the upload and chat endpoints for ASGI deployments (base/asgi.py).
+
+The vector searches and the LLM call are awaited rather than run on a worker thread, so
+one process can keep many slow generations in flight. Database access still goes
+through sync_to_async.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from rag.decorators import async_jwt_required
+from rag.models import ChatSession
+from rag.views import (
+    ChatTurn,
+    InvalidIngestRequest,
+    _ingest_params,
+    _ingest_started,
+    _sse_event,
+    _start_ingest_job,
+    _stream_response,
+    _wants_stream,
+)
+from utils.genration import astream_generation, get_rag_app
+
+
+def _request_data(request):
+    if request.content_type == "application/json":
+        try:
+            return json.loads(request.body or b"{}")
+        except ValueError:
+            return {}
+    return request.POST
+
+
+async def _asse_answer_stream(state, tokens, on_answer):
+    """Async counterpart of views._sse_answer_stream; `tokens` and `on_answer` are awaited."""
+    yield _sse_event("context", {"question": state["question"], "context": state["context"]})
+
+    parts = []
+    async for token in tokens:
+        parts.append(token)
+        yield _sse_event("token", {"token": token})
+
+    answer = "".join(parts).strip()
+    yield _sse_event("done", {"answer": answer, **await on_answer(answer)})
+
+
+async def _single(value):
+    yield value
+
+
+@csrf_exempt
+@require_POST
+@async_jwt_required
+async def rag_ingest_async(request):
+    user = request.user
+    data = _request_data(request)
+    try:
+        try:
+            params, staged = await sync_to_async(_ingest_params)(user, data, request.FILES)
+        except InvalidIngestRequest as e:
+            return JsonResponse({"status": str(e.status), "message": str(e), "data": {}}, status=e.status)
+
+        job = await sync_to_async(_start_ingest_job)(user, data, params, staged)
+        return JsonResponse(_ingest_started(job), status=202)
+
+    except Exception as e:
+        print("Error in rag_ingest_async:", e)
+        return JsonResponse({"status": "500", "message": str(e), "data": {}})
+
+
+@csrf_exempt
+@require_POST
+@async_jwt_required
+async def rag_chat_async(request):
+    data = _request_data(request)
+    turn = ChatTurn(request.user, data)
+
+    if turn.error:
+        return JsonResponse({"error": turn.error}, status=400)
+
+    stream = _wants_stream(data, request.GET)
+    try:
+        await sync_to_async(turn.open)()
+    except ChatSession.DoesNotExist:
+        return JsonResponse({"error": "Unknown session_id"}, status=404)
+
+    finish = sync_to_async(turn.finish)
+
+    # embedding the question is CPU work, keep it off the event loop
+    cached = await sync_to_async(turn.cached_answer, thread_sensitive=False)()
+    if cached is not None:
+        state = {"question": turn.question, "context": cached["context"]}
+        if stream:
+            return _stream_response(_asse_answer_stream(
+                state,
+                _single(cached["answer"]),
+                on_answer=lambda answer: finish(answer, cached["context"], from_cache=True)
+            ))
+        return JsonResponse({
+            "question": turn.question,
+            "context": cached["context"],
+            "answer": cached["answer"],
+            **await finish(cached["answer"], cached["context"], from_cache=True),
+            "cached": True,
+        })
+
+    # building an app connects to Chroma the first time, which blocks
+    rag_app = await sync_to_async(get_rag_app, thread_sensitive=False)(turn.collections, user_id=turn.user.id)
+    state = await rag_app.aretrieve(turn.state())
+
+    if stream:
+        return _stream_response(_asse_answer_stream(
+            state,
+            astream_generation(state, rag_app.chat),
+            on_answer=lambda answer: finish(answer, state["context"])
+        ))
+
+    answer = "".join([token async for token in astream_generation(state, rag_app.chat)]).strip()
+
+    return JsonResponse({
+        "question": turn.question,
+        "context": state["context"],
+        "answer": answer,
+        **await finish(answer, state["context"]),
+    })
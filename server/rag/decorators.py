@@ -1,6 +1,9 @@
 import jwt
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.http import JsonResponse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
 
 def jwt_required(view_func):
     def wrapper(request, *args, **kwargs):
@@ -22,3 +25,24 @@ def jwt_required(view_func):
 
         return view_func(request, *args, **kwargs)
     return wrapper
+
+
+_jwt_authentication = JWTAuthentication()
+
+
+def async_jwt_required(view_func):
+    """
+    Authenticates a plain async Django view the way DRF's JWTAuthentication does for the
+    APIViews, and sets `request.user`. The user lookup runs in the sync thread pool.
+    """
+    async def wrapper(request, *args, **kwargs):
+        try:
+            result = await sync_to_async(_jwt_authentication.authenticate)(request)
+        except AuthenticationFailed as e:
+            return JsonResponse({"error": e.detail}, status=401)
+        if result is None:
+            return JsonResponse({"error": "Authorization header missing"}, status=401)
+
+        request.user = result[0]
+        return await view_func(request, *args, **kwargs)
+    return wrapper
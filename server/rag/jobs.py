@@ -0,0 +1,249 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from rag.models import IngestJob
+from utils.cache import get_answer_cache
+from utils.api_source import SourceNotModified, load_validators, save_validators
+from utils.genration import invalidate_rag_app
+from utils.vectorstore import get_vector_store
+from utils.loader import (
+    expand_uploads,
+    load_files,
+    load_from_api,
+    load_from_mongodb,
+    splitter,
+    store_user_docs
+)
+
+User = get_user_model()
+
+# Ingestion runs on a local worker pool; the IngestJob table is the only shared state,
+# so any server process can report on a job started by another one.
+_workers = getattr(settings, "INGEST_WORKERS", 2)
+_pool = ThreadPoolExecutor(max_workers=_workers, thread_name_prefix="ingest")
+_submitted = 0
+_submitted_lock = threading.Lock()
+
+# Every job this process has queued or is running gets its updated_at touched every
+# INGEST_HEARTBEAT_SECONDS. resume_ingest_jobs only takes over jobs whose heartbeat is
+# older than INGEST_LEASE_SECONDS, so it never runs a job a live server still owns.
+_owned = set()
+_owned_lock = threading.Lock()
+_heartbeat = None
+
+
+def _beat():
+    interval = getattr(settings, "INGEST_HEARTBEAT_SECONDS", 30)
+    while True:
+        time.sleep(interval)
+        with _owned_lock:
+            job_ids = list(_owned)
+        if not job_ids:
+            continue
+        try:
+            close_old_connections()
+            IngestJob.objects.filter(pk__in=job_ids).update(updated_at=timezone.now())
+        except Exception as e:
+            print(f"Ingest heartbeat failed: {e}")
+
+
+def hold_lease(job_id):
+    """Keeps `job_id` leased to this process until `release_lease` is called."""
+    global _heartbeat
+    with _owned_lock:
+        _owned.add(job_id)
+        if _heartbeat is None:
+            _heartbeat = threading.Thread(target=_beat, name="ingest-heartbeat", daemon=True)
+            _heartbeat.start()
+
+
+def release_lease(job_id):
+    with _owned_lock:
+        _owned.discard(job_id)
+
+
+def _write_staged(job, staged):
+    """Moves in-memory uploads into the job's upload_dir, so `resume_ingest_jobs` can find them."""
+    for upload in job.params["files"]:
+        key = upload.pop("staged_key", None)
+        if key is None:
+            continue
+        upload["path"] = os.path.join(
+            job.params["upload_dir"], f"{uuid.uuid4().hex}{os.path.splitext(upload['name'])[-1]}"
+        )
+        with open(upload["path"], "wb") as f:
+            f.write(staged[key])
+    _update(job, params=job.params)
+
+
+def _run_submitted(job_id, staged):
+    global _submitted
+    try:
+        run_ingest_job(job_id, staged)
+    finally:
+        with _submitted_lock:
+            _submitted -= 1
+
+
+def submit_ingest_job(job: IngestJob, staged=None):
+    """
+    `staged` maps staged_key to the bytes of small uploads that were never written to disk.
+    They stay in memory only when the job starts right away; a job that has to wait for
+    a worker gets them written to its upload_dir first, so a restart in the meantime
+    does not lose them.
+    """
+    global _submitted
+    with _submitted_lock:
+        queued = _submitted >= _workers
+        _submitted += 1
+    hold_lease(job.pk)
+    if staged and queued:
+        _write_staged(job, staged)
+        staged = None
+    _pool.submit(_run_submitted, job.pk, staged)
+
+
+def _update(job, **fields):
+    for name, value in fields.items():
+        setattr(job, name, value)
+    job.save(update_fields=[*fields, "updated_at"])
+
+
+def _load_docs(job, validators, staged):
+    params = job.params
+    if job.source_type == "file":
+        def report(name, result):
+            job.files[name] = result
+            _update(job, files=job.files)
+
+        uploads = []
+        for upload in params["files"]:
+            if "path" in upload:
+                uploads.append((upload["path"], upload["name"]))
+            elif upload["staged_key"] in staged:
+                uploads.append((staged[upload["staged_key"]], upload["name"]))
+            else:
+                # in-memory uploads of a job that was already running do not survive a restart
+                report(upload["name"], {"status": "failed", "error": "upload is no longer available"})
+
+        # chunk ids derive from the source, so pages are keyed on the upload name, not the temp path
+        return load_files(expand_uploads(uploads, params["upload_dir"]), report=report)
+    if job.source_type == "api":
+        return load_from_api(
+            params["endpoint_url"],
+            pagination=params.get("pagination"),
+            items_path=params.get("items_path"),
+            text_path=params.get("text_path"),
+            validators=validators,
+            **params.get("page_options", {})
+        )
+    if job.source_type == "mongodb":
+        return load_from_mongodb(
+            params["mongo_uri"],
+            params["db_name"],
+            params["collection_name"],
+            params.get("query") or {},
+            projection=params.get("projection"),
+            text_template=params.get("text_template"),
+            batch_size=params.get("batch_size"),
+            shards=params.get("shards"),
+            warn=lambda message: _update(job, warnings=[*job.warnings, message])
+        )
+    raise ValueError(f"Unknown source_type: {job.source_type}")
+
+
+def _record_doc(user_id, doc_id):
+    with transaction.atomic():
+        user = User.objects.select_for_update().get(pk=user_id)
+        if doc_id not in user.docs:
+            user.docs.append(doc_id)
+            user.save(update_fields=["docs"])
+    invalidate_rag_app(user_id)
+    answer_cache = get_answer_cache()
+    if answer_cache is not None:
+        answer_cache.invalidate_user(user_id)
+
+
+def run_ingest_job(job_id, staged=None):
+    close_old_connections()
+    try:
+        job = IngestJob.objects.get(pk=job_id)
+    except IngestJob.DoesNotExist:
+        release_lease(job_id)
+        raise
+    hold_lease(job_id)
+    try:
+        _update(job, status=IngestJob.RUNNING, stage="loading", error="", files={}, warnings=[])
+        # ETag/Last-Modified are remembered per (document, endpoint), so only a
+        # re-ingest into the same document can be skipped as unchanged
+        validators_key = f"{job.collection_name}|{job.params.get('endpoint_url')}"
+        validators = load_validators(validators_key) if job.source_type == "api" else {}
+        try:
+            docs = _load_docs(job, validators, staged or {})
+        except SourceNotModified:
+            _record_doc(job.user_id, job.collection_name)
+            _update(job, status=IngestJob.SUCCEEDED, stage="unchanged", finished_at=timezone.now())
+            return
+
+        if not docs:
+            raise ValueError("No content could be loaded from the source")
+
+        store = get_vector_store()
+        if not store:
+            raise RuntimeError("Failed to connect to the vector store")
+
+        # chunks are split lazily as they are embedded, so the total is only known at the end
+        _update(job, stage="embedding")
+
+        def progress(processed, total):
+            _update(job, processed_chunks=processed, total_chunks=total or job.total_chunks)
+
+        def on_batch(batch_index):
+            _update(job, committed_batches=batch_index + 1)
+
+        # sharded MongoDB reads and parallel file parsing finish in no fixed order, so batch
+        # indexes mean nothing across runs; resume those by skipping stored chunk ids instead
+        resume_by_id = job.source_type in ("mongodb", "file") and job.committed_batches > 0
+
+        store_user_docs(
+            splitter(docs),
+            store,
+            job.user_id,
+            doc_id=job.collection_name,
+            progress=progress,
+            start_batch=0 if resume_by_id else job.committed_batches,
+            on_batch=on_batch,
+            incremental=job.params.get("incremental", False) or resume_by_id
+        )
+        if job.source_type == "file" and not any(f["status"] == "ok" for f in job.files.values()):
+            raise ValueError("None of the uploaded files could be parsed")
+
+        _record_doc(job.user_id, job.collection_name)
+        if job.source_type == "api":
+            save_validators(validators_key, validators)
+
+        _update(
+            job,
+            status=IngestJob.SUCCEEDED,
+            stage="done",
+            total_chunks=job.processed_chunks,
+            finished_at=timezone.now()
+        )
+    except Exception as e:
+        print(f"Ingest job {job_id} failed: {e}")
+        _update(job, status=IngestJob.FAILED, error=str(e), finished_at=timezone.now())
+    finally:
+        release_lease(job_id)
+        upload_dir = job.params.get("upload_dir")
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+        close_old_connections()
@@ -0,0 +1,97 @@
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utils.embeddings import get_embedding_cache
+from utils.local_vectors import LocalCollection
+from utils.quantization import unit_rows
+
+DEFAULT_MODES = "float32,int8,binary,matryoshka:384,matryoshka:256,pca:256,pca:128"
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures recall@k against exact float32 search, query latency and memory per vector "
+        "for each local vector encoding, with and without full-precision rescoring. The "
+        "corpus is the chunk embeddings in the embedding cache; a held-out part of it serves "
+        "as queries."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=20000, help="Vectors to index")
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--modes", default=DEFAULT_MODES, help="Comma separated LOCAL_VECTOR_ENCODING values")
+        parser.add_argument("--nlist", type=int, default=0, help="IVF lists (0 = exact scan, isolates the encoding)")
+        parser.add_argument("--nprobe", type=int, default=16)
+
+    def handle(self, *args, **options):
+        cache = get_embedding_cache()
+        if cache is None:
+            self.stderr.write("The embedding cache is disabled (EMBEDDING_CACHE_MAX_ENTRIES=0)")
+            return
+
+        vectors = cache.sample(settings.EMBEDDING_MODEL_NAME, options["limit"] + options["queries"])
+        if len(vectors) <= options["queries"]:
+            self.stderr.write("Not enough cached embeddings, ingest some documents first")
+            return
+        vectors = unit_rows(vectors)
+        rng = np.random.default_rng(0)
+        rng.shuffle(vectors)
+        queries, corpus = vectors[:options["queries"]], vectors[options["queries"]:]
+        k = options["k"]
+
+        truth = [set(np.argsort(-(corpus @ query))[:k].tolist()) for query in queries]
+        self.stdout.write(f"{len(corpus)} vectors of {corpus.shape[1]} dims, {len(queries)} queries, k={k}\n")
+        self.stdout.write(
+            f"{'encoding':<16}{'rescore':>8}{'recall@k':>10}{'p50 ms':>9}"
+            f"{'bytes/vec':>11}{'scanned MB':>12}{'rescore MB':>12}"
+        )
+
+        for encoding in options["modes"].split(","):
+            for rescore in (False, True):
+                if rescore and encoding == "float32":
+                    continue  # already exact
+                if not rescore and encoding.startswith("pca"):
+                    continue  # needs the full vectors to be fitted
+                self._run(encoding.strip(), rescore, corpus, queries, truth, k, options)
+
+    def _run(self, encoding, rescore, corpus, queries, truth, k, options):
+        path = tempfile.mkdtemp(prefix="rag_benchmark_")
+        try:
+            collection = LocalCollection(
+                path,
+                "benchmark",
+                encoding=encoding,
+                rescore=rescore,
+                nlist=options["nlist"],
+                nprobe=options["nprobe"],
+            )
+            for start in range(0, len(corpus), 1000):
+                batch = corpus[start:start + 1000]
+                ids = [str(i) for i in range(start, start + len(batch))]
+                collection.upsert(ids, batch, [{"source": "benchmark"}] * len(batch), [""] * len(batch))
+
+            recalls, latencies = [], []
+            for query, expected in zip(queries, truth):
+                started = time.perf_counter()
+                found = collection.search(query, k)
+                latencies.append((time.perf_counter() - started) * 1000)
+                recalls.append(len(expected & {int(doc.id) for doc, _ in found}) / k)
+
+            usage = collection.memory_usage()
+            self.stdout.write(
+                f"{encoding:<16}{'yes' if collection.rescore else 'no':>8}"
+                f"{np.mean(recalls):>10.3f}{np.median(latencies):>9.2f}"
+                f"{usage['scanned_bytes']:>11}"
+                f"{usage['scanned_bytes'] * len(corpus) / 2**20:>12.1f}"
+                f"{usage['rescore_bytes'] * len(corpus) / 2**20:>12.1f}"
+            )
+        except ValueError as e:
+            self.stderr.write(f"{encoding}: {e}")
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
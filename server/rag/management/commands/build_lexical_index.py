@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+
+from utils.cache import bump_collection_version
+from utils.lexical import get_lexical_index
+from utils.vectorstore import get_vector_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Indexes the chunks already stored in the vector store (VECTOR_BACKEND) for hybrid "
+        "search. New ingests keep the lexical index up to date on their own, this is for "
+        "collections written before."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("collections", nargs="*", help="Only index these collections")
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--rebuild", action="store_true", help="Drop each collection's index first")
+
+    def handle(self, *args, **options):
+        index = get_lexical_index()
+        if index is None:
+            self.stderr.write("HYBRID_SEARCH is off, nothing to do")
+            return
+
+        store = get_vector_store()
+        if not store:
+            self.stderr.write("Failed to connect to the vector store")
+            return
+
+        names = options["collections"] or store.list_collections()
+        for name in names:
+            if not store.has_collection(name):
+                self.stderr.write(f"{name}: no such collection")
+                continue
+            if options["rebuild"]:
+                index.drop(name)
+            indexed = self._index(store.collection(name), index, options["batch_size"])
+            # the version table is shared, so the servers drop their cached retrievals,
+            # which lack the keyword hits indexed here
+            bump_collection_version(name)
+            self.stdout.write(f"{name}: {indexed} chunks indexed")
+
+    def _index(self, collection, index, batch_size):
+        indexed = 0
+        for ids, _, metadatas, documents in collection.iterate(batch_size):
+            for metadata in metadatas:
+                metadata.setdefault("source", "unknown")
+            index.add(collection.name, ids, [text or "" for text in documents], metadatas)
+            indexed += len(ids)
+        return indexed
@@ -0,0 +1,72 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from utils.cache import bump_collection_version
+from utils.chroma import user_collection_name
+from utils.lexical import get_lexical_index
+from utils.vectorstore import get_vector_store
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Folds every per-upload collection listed in User.docs into the owner's single "
+        "per-user collection, tagging each chunk with the old collection name as doc_id. "
+        "Works on the store selected by VECTOR_BACKEND."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--email", help="Only migrate this user")
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--delete", action="store_true", help="Delete the old collections once copied")
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        store = get_vector_store()
+        if not store:
+            self.stderr.write("Failed to connect to the vector store")
+            return
+
+        users = User.objects.exclude(docs=[])
+        if options["email"]:
+            users = users.filter(email=options["email"])
+
+        for user in users:
+            target_name = user_collection_name(user.id)
+            target = None if options["dry_run"] else store.collection(target_name)
+
+            for doc_id in user.docs:
+                # already folded in (or never existed)
+                if doc_id == target_name or not store.has_collection(doc_id):
+                    continue
+
+                copied = self._copy(store.collection(doc_id), target, doc_id, options["batch_size"])
+                self.stdout.write(f"{user.email}: {doc_id} -> {target_name} ({copied} chunks)")
+
+                if options["delete"] and not options["dry_run"]:
+                    store.delete_collection(doc_id)
+                    if get_lexical_index() is not None:
+                        get_lexical_index().drop(doc_id)
+                    bump_collection_version(doc_id)
+
+            if target is not None:
+                bump_collection_version(target_name)
+
+        if options["dry_run"]:
+            self.stdout.write("Dry run, nothing was written")
+
+    def _copy(self, source, target, doc_id, batch_size):
+        copied = 0
+        for ids, vectors, metadatas, documents in source.iterate(batch_size, include_vectors=target is not None):
+            for metadata in metadatas:
+                metadata.setdefault("source", "unknown")
+                metadata["doc_id"] = doc_id
+
+            if target is not None:
+                target_ids = [f"{doc_id}:{chunk_id}" for chunk_id in ids]
+                target.upsert(target_ids, vectors, metadatas, documents)
+                if get_lexical_index() is not None:
+                    get_lexical_index().add(target.name, target_ids, documents, metadatas)
+            copied += len(ids)
+        return copied
@@ -0,0 +1,71 @@
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from rag.jobs import run_ingest_job
+from rag.models import IngestJob
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-runs ingest jobs that were interrupted (left queued or running by a crashed "
+        "worker), continuing each one after its last committed batch. A job counts as "
+        "interrupted once its heartbeat is older than INGEST_LEASE_SECONDS, so jobs a live "
+        "server still owns are left alone. Small uploads that a running job still held in "
+        "memory can not be recovered and are reported as failed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("job_ids", nargs="*", type=int, help="Only resume these jobs")
+        parser.add_argument("--include-failed", action="store_true", help="Also retry failed jobs")
+        parser.add_argument(
+            "--lease-seconds",
+            type=int,
+            default=getattr(settings, "INGEST_LEASE_SECONDS", 120),
+            help="Seconds without a heartbeat after which a job is taken over"
+        )
+
+    def _claim(self, job_id, statuses, cutoff):
+        """
+        Locks the job row and renews its heartbeat, so a second resume_ingest_jobs (or a
+        server that is only slow) can not pick the same job. None if it is still leased.
+        """
+        with transaction.atomic():
+            job = (
+                IngestJob.objects.select_for_update(skip_locked=True)
+                .filter(pk=job_id, status__in=statuses, updated_at__lt=cutoff)
+                .first()
+            )
+            if job is not None:
+                job.save(update_fields=["updated_at"])
+            return job
+
+    def handle(self, *args, **options):
+        statuses = [IngestJob.QUEUED, IngestJob.RUNNING]
+        if options["include_failed"]:
+            statuses.append(IngestJob.FAILED)
+        cutoff = timezone.now() - timedelta(seconds=options["lease_seconds"])
+
+        jobs = IngestJob.objects.filter(status__in=statuses).order_by("created_at")
+        if options["job_ids"]:
+            jobs = jobs.filter(pk__in=options["job_ids"])
+
+        for job_id in jobs.values_list("pk", flat=True):
+            job = self._claim(job_id, statuses, cutoff)
+            if job is None:
+                self.stderr.write(f"Job {job_id}: still leased by a running worker, skipping")
+                continue
+
+            upload_dir = job.params.get("upload_dir")
+            if upload_dir and not os.path.isdir(upload_dir):
+                self.stderr.write(f"Job {job.pk}: uploaded files are gone, skipping")
+                continue
+
+            self.stdout.write(f"Resuming job {job.pk} from batch {job.committed_batches}")
+            run_ingest_job(job.pk)
+            job.refresh_from_db()
+            self.stdout.write(f"Job {job.pk}: {job.status}")
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestjob',
+            name='committed_batches',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0002_ingestjob_committed_batches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestjob',
+            name='files',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
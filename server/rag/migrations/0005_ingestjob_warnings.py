@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0004_chatsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestjob',
+            name='warnings',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,65 @@
+import uuid
+
+from django.conf import settings
+from django.db import models
+
+
+class IngestJob(models.Model):
+    """A background ingestion run started from /rag/upload/"""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (SUCCEEDED, "Succeeded"),
+        (FAILED, "Failed"),
+    ]
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="ingest_jobs"
+    )
+    source_type = models.CharField(max_length=20)
+    params = models.JSONField(default=dict, blank=True)
+    collection_name = models.CharField(max_length=100)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    stage = models.CharField(max_length=20, default=QUEUED)
+    total_chunks = models.IntegerField(default=0)
+    processed_chunks = models.IntegerField(default=0)
+    committed_batches = models.IntegerField(default=0)
+    files = models.JSONField(default=dict, blank=True)
+    # problems that did not fail the job, e.g. a source read more slowly than asked for
+    warnings = models.JSONField(default=list, blank=True)
+    error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.source_type} job {self.pk} ({self.status})"
+
+
+class ChatSession(models.Model):
+    """
+    Server-side conversation memory for /rag/chat/. Only the latest turns are kept
+    verbatim; older ones are folded into `summary`.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="chat_sessions"
+    )
+    summary = models.TextField(blank=True)
+    turns = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Chat session {self.pk} ({self.user})"
@@ -0,0 +1,23 @@
+from rest_framework import serializers
+from .models import IngestJob
+
+
+class IngestJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = IngestJob
+        fields = [
+            "id",
+            "source_type",
+            "collection_name",
+            "status",
+            "stage",
+            "total_chunks",
+            "processed_chunks",
+            "committed_batches",
+            "files",
+            "warnings",
+            "error",
+            "created_at",
+            "updated_at",
+            "finished_at",
+        ]
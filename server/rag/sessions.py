@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections, transaction
+
+from rag.models import ChatSession
+from utils.genration import get_chat_model, summarize_history
+
+_summarizer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chat-summary")
+
+
+def _snapshot(session: ChatSession) -> dict:
+    return {"user_id": session.user_id, "summary": session.summary, "turns": list(session.turns)}
+
+
+def load_session(user, session_id=None) -> tuple:
+    """
+    Returns (session_id, {"summary", "turns"}) for one of the user's sessions, starting a
+    new session when `session_id` is empty. Raises ChatSession.DoesNotExist for an unknown
+    or foreign id.
+    """
+    if not session_id:
+        session = ChatSession.objects.create(user=user)
+        return str(session.pk), _snapshot(session)
+
+    # always read the row: the turn before may have been recorded, or summarized, by
+    # another worker process
+    try:
+        session = ChatSession.objects.get(pk=session_id, user=user)
+    except ValidationError:
+        raise ChatSession.DoesNotExist(session_id)
+    return str(session.pk), _snapshot(session)
+
+
+def record_turn(session_id: str, question: str, answer: str):
+    """
+    Appends a turn and, once too many are kept verbatim, summarizes the oldest in the
+    background. Until that summary is saved the turns stay in `turns`, so every turn is
+    always either verbatim or in the summary.
+    """
+    with transaction.atomic():
+        session = ChatSession.objects.select_for_update().get(pk=session_id)
+        session.turns = session.turns + [{"q": question, "a": answer}]
+        session.save(update_fields=["turns", "updated_at"])
+
+    if len(session.turns) > getattr(settings, "CHAT_SESSION_MAX_TURNS", 6):
+        _summarizer.submit(_fold_old_turns, session_id)
+
+
+def _fold_old_turns(session_id: str):
+    close_old_connections()
+    try:
+        session = ChatSession.objects.get(pk=session_id)
+        keep = getattr(settings, "CHAT_SESSION_KEEP_TURNS", 3)
+        folded = session.turns[:-keep]
+        if not folded:
+            return
+
+        # the LLM call happens outside the row lock; new turns may arrive meanwhile
+        summary = summarize_history(get_chat_model(), session.summary, folded)
+
+        with transaction.atomic():
+            session = ChatSession.objects.select_for_update().get(pk=session_id)
+            if session.turns[:len(folded)] != folded:
+                return  # another summarizer got there first
+            session.summary = summary
+            session.turns = session.turns[len(folded):]
+            session.save(update_fields=["summary", "turns", "updated_at"])
+    except Exception as e:
+        print(f"Summarizing chat session {session_id} failed: {e}")
+    finally:
+        close_old_connections()
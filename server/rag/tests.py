@@ -1,3 +1,1019 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+from langchain_core.documents import Document
+
+from rag.jobs import run_ingest_job
+from rag.models import ChatSession, IngestJob
+from rag.sessions import _fold_old_turns, load_session, record_turn
+from rag.views import ChatTurn, InvalidIngestRequest, RAGMetricsView, _ingest_params
+from utils.api_source import SourceNotModified, fetch_pages, json_path
+from utils.cache import SemanticAnswerCache, TTLCache, bump_collection_version
+from utils.context import build_context, estimate_tokens
+from utils.embedding_cache import EmbeddingCache, text_hash
+from utils.embeddings import embed_documents_cached
+from utils.genration import make_retrieve_node, make_user_retriever
+from utils.lexical import LexicalIndex, tokenize
+from utils.loader import _render_mongo_doc, chunk_id, embedings_store, load_from_mongodb, splitter, validate_text_template
+from utils.local_vectors import LocalCollection, LocalVectorStore
+from utils.quantization import BinaryCodec, Int8Codec, PCACodec, TruncateCodec, make_codec, unit_rows
+from utils.rerank import CrossEncoderReranker
+from utils.retrieval import DISTANCE_SCALES, reciprocal_rank_fusion, select_relevant
+
+try:
+    import mongomock
+except ImportError:  # test-only dependency
+    mongomock = None
+
+
+def _doc(text, **metadata):
+    return Document(page_content=text, metadata=metadata)
+
+
+def _fake_embeddings(texts):
+    # deterministic stand-in for the embedding model, one distinct vector per text
+    return [np.random.default_rng(list(text.encode())).normal(size=8).tolist() for text in texts]
+
+
+class SelectRelevantTests(SimpleTestCase):
+    def test_distances_are_scaled_per_metric(self):
+        candidates = [(_doc("cosine"), 0.4), (_doc("l2"), 0.4), (_doc("ip"), 0.1)]
+        scales = [DISTANCE_SCALES["cosine"], DISTANCE_SCALES["l2"], DISTANCE_SCALES["ip"]]
+
+        ranked = select_relevant(candidates, scales, threshold=0.0, k=3)
+
+        self.assertEqual([doc.page_content for doc, _ in ranked], ["ip", "l2", "cosine"])
+        for (_, relevance), expected in zip(ranked, [0.9, 0.8, 0.6]):
+            self.assertAlmostEqual(relevance, expected, places=5)
+
+    def test_threshold_and_k(self):
+        candidates = [(_doc(str(i)), i / 10) for i in range(10)]
+
+        ranked = select_relevant(candidates, [1.0] * 10, threshold=0.65, k=2)
+
+        self.assertEqual([doc.page_content for doc, _ in ranked], ["0", "1"])
+        self.assertEqual(select_relevant(candidates, [1.0] * 10, threshold=0.99, k=5)[0][1], 1.0)
+        self.assertEqual(select_relevant([], [], threshold=0.0, k=5), [])
+
+    def test_relevance_is_clipped(self):
+        ranked = select_relevant([(_doc("far"), 3.0)], [DISTANCE_SCALES["l2"]], threshold=0.0, k=1)
+        self.assertEqual(ranked[0][1], 0.0)
+
+
+class BuildContextTests(SimpleTestCase):
+    def test_overlapping_chunks_of_a_source_are_merged(self):
+        docs = [
+            _doc("brown fox jumps over the lazy dog", source="a.pdf", start_index=10, relevance=0.7),
+            _doc("The quick brown fox jumps", source="a.pdf", start_index=0, relevance=0.9),
+        ]
+        self.assertEqual(build_context(docs, token_budget=100), "The quick brown fox jumps over the lazy dog")
+
+    def test_records_of_one_source_are_not_merged(self):
+        texts = ["Invoice 1001 was paid on March 3.", "Invoice 1002 is overdue.", "For refunds, contact billing."]
+        api_items = [
+            _doc(text, source="https://example.test/api", index=i, start_index=0, relevance=1 - i / 10)
+            for i, text in enumerate(texts)
+        ]
+        mongo_records = [
+            _doc(text, source="mongodb/db/items", id=str(i), start_index=0, relevance=1 - i / 10)
+            for i, text in enumerate(texts)
+        ]
+        for docs in (api_items, mongo_records):
+            self.assertEqual(build_context(docs, token_budget=100, separator="|"), "|".join(texts))
+
+    def test_chunks_without_offsets_are_merged_on_the_text_overlap(self):
+        overlap = "shared sentence of the splitter overlap. "
+        docs = [
+            _doc("First part. " + overlap, source="a.txt", relevance=0.8),
+            _doc(overlap + "Second part.", source="a.txt", relevance=0.6),
+            _doc("First part.", source="a.txt", relevance=0.5),
+        ]
+        self.assertEqual(build_context(docs, token_budget=100), "First part. " + overlap + "Second part.")
+
+    def test_passages_are_ordered_by_relevance_within_the_budget(self):
+        docs = [
+            _doc("low " * 10, source="a", relevance=0.2),
+            _doc("high " * 10, source="b", relevance=0.9),
+            _doc("middle " * 10, source="c", relevance=0.5),
+        ]
+        context = build_context(docs, token_budget=estimate_tokens("high " * 10) + 5)
+
+        self.assertEqual(context, ("high " * 10))
+        self.assertEqual(build_context([]), "")
+
+    def test_long_tail_passage_is_cut_at_a_word(self):
+        docs = [_doc("word " * 200, source="a", relevance=0.9)]
+        context = build_context(docs, token_budget=60)
+
+        self.assertLessEqual(estimate_tokens(context), 60)
+        self.assertTrue(context.endswith("word"))
+
+
+class ReciprocalRankFusionTests(SimpleTestCase):
+    def test_documents_in_both_rankings_come_first(self):
+        vector = [_doc("a"), _doc("c"), _doc("b")]
+        keyword = [_doc("c"), _doc("d")]
+
+        fused = reciprocal_rank_fusion([vector, keyword], k=3, key=lambda doc: doc.page_content, rrf_k=60)
+
+        self.assertEqual([doc.page_content for doc, _ in fused], ["c", "a", "d"])
+        self.assertAlmostEqual(fused[0][1], 1 / 62 + 1 / 61)
+
+    def test_k(self):
+        ranking = [_doc(str(i)) for i in range(5)]
+        self.assertEqual(reciprocal_rank_fusion([ranking], k=0, key=lambda doc: doc.page_content), [])
+        self.assertEqual(len(reciprocal_rank_fusion([ranking], k=2, key=lambda doc: doc.page_content)), 2)
+
+
+class LexicalIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="rag_test_")
+        self.index = LexicalIndex(f"{self.path}/lexical.sqlite3")
+        self.index.add(
+            "c",
+            ["1", "2", "3"],
+            [
+                "Error ERR-0042 is raised when the disk is full",
+                "The disk controller was replaced",
+                "Release notes for v2.3.1",
+            ],
+            [{"doc_id": "a"}, {"doc_id": "a"}, {"doc_id": "b"}],
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def ids(self, query, k=10, **kwargs):
+        return [id_ for id_, *_ in self.index.search("c", query, k, **kwargs)]
+
+    def test_tokenize_keeps_identifiers_and_their_parts(self):
+        self.assertEqual(tokenize("ERR-0042 v2.3.1"), ["err-0042", "err", "0042", "v2.3.1", "v2", "3", "1"])
+
+    def test_search(self):
+        self.assertEqual(self.ids("ERR-0042"), ["1"])
+        self.assertEqual(self.ids("v2.3.1"), ["3"])
+        self.assertEqual(self.ids("disk"), ["2", "1"])  # the shorter chunk wins
+        self.assertEqual(self.ids("disk", k=1), ["2"])
+        self.assertEqual(self.ids("nothing matches"), [])
+        self.assertEqual(self.index.search("other", "disk", 10), [])
+
+        id_, score, text, metadata = self.index.search("c", "ERR-0042", 1)[0]
+        self.assertGreater(score, 0)
+        self.assertEqual(metadata, {"doc_id": "a"})
+
+    def test_doc_id_filter(self):
+        self.assertEqual(self.ids("disk release", doc_ids=["b"]), ["3"])
+        self.assertEqual(self.ids("disk", doc_ids=[]), [])
+
+    def test_stats_follow_writes_of_other_processes(self):
+        self.assertEqual(self.index._collection_stats("c")[0], 3)
+        other = LexicalIndex(self.index.path)
+        other.add("c", ["4", "5"], ["Fan noise", "Fan speed"], [{"doc_id": "a"}, {"doc_id": "a"}])
+        bump_collection_version("c")
+        self.assertEqual(self.index._collection_stats("c")[0], 5)
+
+    def test_updates(self):
+        self.index.add("c", ["2"], ["A new fan was installed"], [{"doc_id": "a"}])
+        self.assertEqual(self.ids("disk"), ["1"])
+        self.assertEqual(self.ids("fan"), ["2"])
+
+        self.index.delete("c", ["1"])
+        self.assertEqual(self.ids("disk"), [])
+
+        self.index.drop("c")
+        self.assertEqual(self.ids("release"), [])
+
+
+class _Response:
+    def __init__(self, payload, headers=None, next_url=None):
+        self.payload = payload
+        self.headers = headers or {}
+        self.links = {"next": {"url": next_url}} if next_url else {}
+
+    def json(self):
+        return self.payload
+
+
+class JsonPathTests(SimpleTestCase):
+    data = {"data": {"items": [{"title": "a"}, {"title": "b"}, {"name": "c"}]}, "odd key": 1}
+
+    def test_paths(self):
+        self.assertEqual(json_path(self.data, "$.data.items[*].title"), ["a", "b"])
+        self.assertEqual(json_path(self.data, "data.items[0].title"), ["a"])
+        self.assertEqual(json_path(self.data, "$.data.items[-1]"), [{"name": "c"}])
+        self.assertEqual(json_path(self.data, "$['odd key']"), [1])
+        self.assertEqual(json_path(self.data, "$.data.items[9]"), [])
+        self.assertEqual(json_path(self.data, "$.missing.title"), [])
+        self.assertEqual(json_path(self.data, "$"), [self.data])
+
+
+class FetchPagesTests(SimpleTestCase):
+    url = "https://example.test/items"
+
+    def fetch(self, responses, **kwargs):
+        with mock.patch("utils.api_source._get", side_effect=responses) as get:
+            items = list(fetch_pages(self.url, max_pages=10, **kwargs))
+        return items, get
+
+    def test_single_request(self):
+        items, _ = self.fetch(lambda url, params=None, headers=None: _Response({"items": [1, 2]}), items_path="$.items[*]")
+        self.assertEqual(items, [1, 2])
+
+    def test_offset_pages_stop_at_a_short_page(self):
+        pages = {0: [1, 2], 2: [3, 4], 4: [5]}
+
+        def get(url, params=None, headers=None):
+            return _Response(pages.get(params["offset"], []))
+
+        items, get_mock = self.fetch(get, pagination="offset", page_size=2, concurrency=2)
+
+        self.assertEqual(items, [1, 2, 3, 4, 5])
+        self.assertEqual(get_mock.call_args_list[0].kwargs["params"], {"limit": 2, "offset": 0})
+
+    def test_page_numbers_start_at_one(self):
+        pages = {1: ["a", "b"], 2: ["c"]}
+
+        def get(url, params=None, headers=None):
+            return _Response(pages.get(params["page"], []))
+
+        items, _ = self.fetch(get, pagination="page", page_size=2, concurrency=3)
+        self.assertEqual(items, ["a", "b", "c"])
+
+    def test_cursor(self):
+        pages = {None: ({"items": [1], "next": "b"}), "b": {"items": [2], "next": None}}
+
+        def get(url, params=None, headers=None):
+            return _Response(pages[params.get("cursor")])
+
+        items, _ = self.fetch(get, pagination="cursor", items_path="$.items[*]", cursor_path="$.next")
+        self.assertEqual(items, [1, 2])
+
+    def test_link_header(self):
+        responses = iter([_Response([1], next_url=f"{self.url}?page=2"), _Response([2])])
+        items, _ = self.fetch(lambda *args, **kwargs: next(responses), pagination="link")
+        self.assertEqual(items, [1, 2])
+
+    def test_single_request_is_conditional(self):
+        validators = {"etag": '"v1"'}
+        items, get = self.fetch(
+            lambda *args, **kwargs: _Response([1], headers={"ETag": '"v2"'}), validators=validators
+        )
+
+        self.assertEqual(items, [1])
+        self.assertEqual(get.call_args.kwargs["headers"], {"If-None-Match": '"v1"'})
+        self.assertEqual(validators, {"etag": '"v2"'})
+
+        with mock.patch("utils.api_source._get", side_effect=SourceNotModified(self.url)):
+            with self.assertRaises(SourceNotModified):
+                list(fetch_pages(self.url, validators=validators))
+
+    def test_paginated_sources_are_always_fetched_in_full(self):
+        # a 304 on the first page would hide changes on the later ones
+        pages = {0: [1, 2], 2: [3]}
+        validators = {"etag": '"v1"'}
+
+        def get(url, params=None, headers=None):
+            return _Response(pages.get(params["offset"], []), headers={"ETag": '"v2"'})
+
+        items, get_mock = self.fetch(get, pagination="offset", page_size=2, validators=validators)
+
+        self.assertEqual(items, [1, 2, 3])
+        self.assertFalse(get_mock.call_args_list[0].kwargs["headers"])
+        self.assertEqual(validators, {})
+
+
+@skipUnless(mongomock, "mongomock is not installed")
+class MongoLoaderTests(SimpleTestCase):
+    def setUp(self):
+        self.client = mongomock.MongoClient()
+        self.client.db.items.insert_many(
+            [{"_id": i, "title": f"Item {i}", "secret": "hidden"} for i in range(25)]
+        )
+
+    def load(self, query=None, **kwargs):
+        return list(load_from_mongodb("mongodb://test", "db", "items", query or {}, client=self.client, **kwargs))
+
+    def test_records_are_streamed_with_projection_and_template(self):
+        warnings = []
+        docs = self.load(
+            {"_id": {"$gte": 5}},
+            projection={"title": 1},
+            text_template="{title} {{literal}} {secret}{missing}",
+            batch_size=4,
+            warn=warnings.append,
+        )
+
+        self.assertEqual(len(docs), 20)
+        self.assertIn("Item 5 {literal} ", [doc.page_content for doc in docs])
+        self.assertEqual(docs[0].metadata["source"], "mongodb/db/items")
+        # mongomock has no $bucketAuto, so the loader fell back to one cursor and said so
+        self.assertEqual(len(warnings), 1)
+
+    def test_shards_read_every_record_once(self):
+        ranges = [{"$gte": 0, "$lt": 10}, {"$gte": 10, "$lt": 20}, {"$gte": 20, "$lte": 24}]
+        with mock.patch("utils.loader._mongo_id_ranges", return_value=ranges):
+            docs = self.load(shards=3)
+        self.assertEqual(sorted(int(doc.metadata["id"]) for doc in docs), list(range(25)))
+
+    def test_templates_only_take_plain_fields(self):
+        self.assertEqual(_render_mongo_doc({"a": 1, "_id": 2}), "a: 1")
+        for template in ("{_id.__init__.__globals__}", "{title[0]}", "{title!r}", "{title:>10}", "{", "}"):
+            with self.subTest(template=template):
+                with self.assertRaises(ValueError):
+                    validate_text_template(template)
+                with self.assertRaises(ValueError):
+                    self.load(text_template=template)
+
+    def test_bad_template_is_a_bad_request(self):
+        data = {"source_type": "mongodb", "mongo_uri": "mongodb://test", "db_name": "db",
+                "collection_name": "items", "text_template": "{_id.__class__}"}
+        with self.assertRaises(InvalidIngestRequest) as raised:
+            _ingest_params(SimpleNamespace(docs=[]), data, MultiValueDict())
+        self.assertEqual(raised.exception.status, 400)
+
+
+class IngestParamsTests(SimpleTestCase):
+    def params(self, **data):
+        return _ingest_params(SimpleNamespace(docs=["mine"]), data, MultiValueDict())
+
+    def test_api_and_mongodb_options(self):
+        params, staged = self.params(
+            source_type="api", endpoint_url="https://example.test", pagination="offset", page_size="50"
+        )
+        self.assertEqual(params["page_options"], {"page_size": 50})
+        self.assertEqual(staged, {})
+
+        params, _ = self.params(
+            source_type="mongodb", mongo_uri="mongodb://test", db_name="db", collection_name="c", shards="2"
+        )
+        self.assertEqual(params["shards"], 2)
+
+    def test_bad_requests(self):
+        mongodb = {"source_type": "mongodb", "mongo_uri": "mongodb://test", "db_name": "db", "collection_name": "c"}
+        api = {"source_type": "api", "endpoint_url": "https://example.test"}
+        for data in (
+            {**api, "page_size": "ten"},
+            {**api, "max_pages": "0"},
+            {**api, "pagination": "sideways"},
+            {**mongodb, "batch_size": "1.5"},
+            {**mongodb, "shards": "-2"},
+            {"source_type": "file"},
+        ):
+            with self.subTest(data=data):
+                with self.assertRaises(InvalidIngestRequest) as raised:
+                    self.params(**data)
+                self.assertEqual(raised.exception.status, 400)
+
+        with self.assertRaises(InvalidIngestRequest) as raised:
+            self.params(**api, chroma_collection="someone-elses")
+        self.assertEqual(raised.exception.status, 404)
+
+
+class ChatTurnTests(SimpleTestCase):
+    def turn(self, **data):
+        return ChatTurn(SimpleNamespace(id=1, docs=["a"]), {"question": "q", "history": [], **data})
+
+    def test_retrieval_options_are_clamped(self):
+        self.assertEqual(self.turn().options, {})
+        self.assertEqual(self.turn(k="5", threshold="0.4").options, {"k": 5, "threshold": 0.4})
+        with self.settings(RETRIEVAL_MAX_K=20):
+            self.assertEqual(self.turn(k="100000", threshold="7").options, {"k": 20, "threshold": 1.0})
+        self.assertEqual(self.turn(k="-3", threshold="-1").options, {"k": 1, "threshold": 0.0})
+
+    def test_bad_input(self):
+        self.assertIsNone(self.turn(k="5").error)
+        self.assertEqual(ChatTurn(SimpleNamespace(id=1, docs=[]), {}).error, "Question is required")
+        for data in ({"k": "abc"}, {"k": "2.5"}, {"threshold": "high"}, {"threshold": "nan"}):
+            with self.subTest(data=data):
+                self.assertIsNotNone(self.turn(**data).error)
+
+
+class SplitterTests(SimpleTestCase):
+    def test_chunks_keep_their_documents_metadata(self):
+        docs = iter([
+            _doc("alpha " * 200, source="a.pdf", page=3, tags=["x"], empty=None),
+            _doc("beta", source="b.txt"),
+            _doc("gamma"),
+        ])
+        chunks = list(splitter(docs, chunk_size=100, chunk_overlap=20))
+
+        first = [chunk for chunk in chunks if chunk.metadata["source"] == "a.pdf"]
+        self.assertGreater(len(first), 1)
+        self.assertTrue(all(chunk.page_content.startswith("alpha") for chunk in first))
+        # unsupported values are stringified or dropped, never merged across documents
+        self.assertEqual(first[0].metadata, {"source": "a.pdf", "page": 3, "tags": "['x']", "start_index": 0})
+        self.assertGreater(first[1].metadata["start_index"], 0)
+        self.assertEqual([chunk.page_content for chunk in chunks[len(first):]], ["beta", "gamma"])
+        self.assertEqual(chunks[-1].metadata["source"], "unknown")
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="rag_test_")
+        self.cache = EmbeddingCache(f"{self.path}/embeddings.sqlite3", max_entries=10)
+        clock = iter(range(1, 1000))
+        patch = mock.patch("utils.embedding_cache.time.time", side_effect=lambda: next(clock))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def put(self, *names, model="m"):
+        self.cache.put_many(model, list(names), [[float(len(name)), 0.5] for name in names])
+
+    def test_vectors_are_kept_per_model(self):
+        self.put("a", "bb")
+        self.assertEqual(self.cache.get_many("m", ["a", "bb", "c"]), {"a": [1.0, 0.5], "bb": [2.0, 0.5]})
+        self.assertEqual(self.cache.get_many("other", ["a"]), {})
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+
+    def test_least_recently_used_vectors_are_evicted(self):
+        names = [f"v{i}" for i in range(10)]
+        self.put(*names)
+        self.cache.get_many("m", ["v0", "v1"])
+        self.put("new")
+
+        # over max_entries the oldest are dropped down to 90% of it
+        left = self.cache.get_many("m", names + ["new"])
+        self.assertEqual(len(left), 9)
+        self.assertTrue({"v0", "v1", "new"} <= left.keys())
+
+    def test_only_missing_chunks_are_embedded(self):
+        embeddings = mock.Mock()
+        embeddings.embed_documents.side_effect = lambda texts: [[float(len(text))] for text in texts]
+        self.cache.put_many("model", [text_hash("cached")], [[6.0]])
+        with mock.patch("utils.embeddings.get_embeddings", return_value=embeddings), \
+                mock.patch("utils.embeddings.get_embedding_cache", return_value=self.cache), \
+                mock.patch("utils.embeddings._model_config", return_value=("model", "cpu", 32)):
+            vectors = embed_documents_cached(["cached", "new", "new"])
+
+        self.assertEqual(vectors, [[6.0], [3.0], [3.0]])
+        embeddings.embed_documents.assert_called_once_with(["new"])
+
+
+class EmbedingsStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="rag_test_")
+        self.store = LocalVectorStore(self.path, nlist=0)
+        self.embedded = []
+        patches = [
+            mock.patch("utils.loader.embed_documents_cached", side_effect=self.embed),
+            mock.patch("utils.loader.get_lexical_index", return_value=None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def embed(self, texts):
+        self.embedded.append(list(texts))
+        return _fake_embeddings(texts)
+
+    def stored(self):
+        return self.store.collection("c").stored()
+
+    def test_batches_are_reported_as_they_are_committed(self):
+        docs = [_doc(f"chunk {i}", source="s") for i in range(5)]
+        committed, progress = [], []
+        embedings_store(docs, self.store, "c", batch_size=2, on_batch=committed.append,
+                        progress=lambda processed, total: progress.append((processed, total)))
+
+        self.assertEqual(committed, [0, 1, 2])
+        self.assertEqual(progress[-1], (5, 5))
+        self.assertEqual([len(texts) for texts in self.embedded], [2, 2, 1])
+        self.assertEqual(len(self.stored()), 5)
+
+    def test_an_interrupted_store_resumes_after_the_last_committed_batch(self):
+        docs = [_doc(f"chunk {i}", source="s") for i in range(5)]
+        committed = []
+        with mock.patch("utils.loader.embed_documents_cached", side_effect=[
+            _fake_embeddings(["chunk 0", "chunk 1"]), _fake_embeddings(["chunk 2", "chunk 3"]), RuntimeError("down")
+        ]):
+            with self.assertRaises(RuntimeError):
+                embedings_store(docs, self.store, "c", batch_size=2, on_batch=committed.append)
+        # batch 1 was being written when batch 2 failed, only batch 0 is known to be committed
+        self.assertEqual(committed, [0])
+
+        embedings_store(docs, self.store, "c", batch_size=2, start_batch=committed[-1] + 1, on_batch=committed.append)
+        self.assertEqual(self.embedded, [["chunk 2", "chunk 3"], ["chunk 4"]])
+        self.assertEqual(committed, [0, 1, 2])
+        self.assertEqual(len(self.stored()), 5)
+
+    def test_only_changed_chunks_are_written(self):
+        embedings_store(
+            [_doc("intro", source="a"), _doc("old", source="a"), _doc("appendix", source="b")],
+            self.store, "c", doc_id="d"
+        )
+        self.embedded.clear()
+
+        # source "a" is uploaded again with one chunk changed; "b" is not part of this upload
+        embedings_store(
+            [_doc("intro", source="a"), _doc("new", source="a")],
+            self.store, "c", doc_id="d", incremental=True
+        )
+        self.assertEqual(self.embedded, [["new"]])
+        self.assertEqual(
+            set(self.stored()),
+            {chunk_id("intro", "a", "d"), chunk_id("new", "a", "d"), chunk_id("appendix", "b", "d")}
+        )
+
+    def test_other_documents_are_left_alone(self):
+        embedings_store([_doc("intro", source="a")], self.store, "c", doc_id="d")
+        embedings_store([_doc("other", source="a")], self.store, "c", doc_id="e", incremental=True)
+        self.assertEqual(set(self.stored()), {chunk_id("intro", "a", "d"), chunk_id("other", "a", "e")})
+
+
+class ChunkIdTests(SimpleTestCase):
+    def test_ids_derive_from_source_text_and_document(self):
+        self.assertEqual(chunk_id("text", "a.pdf"), chunk_id("text", "a.pdf"))
+        self.assertNotEqual(chunk_id("text", "a.pdf"), chunk_id("text", "b.pdf"))
+        self.assertNotEqual(chunk_id("text", "a.pdf"), chunk_id("other", "a.pdf"))
+        self.assertEqual(chunk_id("text", "a.pdf", "doc_1"), f"doc_1:{chunk_id('text', 'a.pdf')}")
+
+
+class ChatSessionTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email="a@example.com", password="x")
+        patch = mock.patch("rag.sessions.close_old_connections")
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_sessions_belong_to_their_user(self):
+        session_id, session = load_session(self.user)
+        self.assertEqual(session, {"user_id": self.user.pk, "summary": "", "turns": []})
+        self.assertEqual(load_session(self.user, session_id)[0], session_id)
+
+        other = get_user_model().objects.create_user(email="b@example.com", password="x")
+        for user, unknown in ((other, session_id), (self.user, "not-a-uuid"), (self.user, str(uuid.uuid4()))):
+            with self.subTest(unknown=unknown), self.assertRaises(ChatSession.DoesNotExist):
+                load_session(user, unknown)
+
+    def turns(self, count):
+        return [{"q": f"q{i}", "a": f"a{i}"} for i in range(count)]
+
+    def test_old_turns_are_summarized_once_there_are_too_many(self):
+        session_id, _ = load_session(self.user)
+        with self.settings(CHAT_SESSION_MAX_TURNS=6, CHAT_SESSION_KEEP_TURNS=3), \
+                mock.patch("rag.sessions._summarizer") as summarizer:
+            for turn in self.turns(7):
+                record_turn(session_id, turn["q"], turn["a"])
+                self.assertEqual(summarizer.submit.called, turn["q"] == "q6")
+
+            with mock.patch("rag.sessions.get_chat_model"), \
+                    mock.patch("rag.sessions.summarize_history", return_value="summary") as summarize:
+                _fold_old_turns(session_id)
+
+        self.assertEqual(summarize.call_args.args[1:], ("", self.turns(4)))
+        self.assertEqual(load_session(self.user, session_id)[1]["summary"], "summary")
+        self.assertEqual(load_session(self.user, session_id)[1]["turns"], self.turns(7)[4:])
+
+    def test_a_summary_saved_meanwhile_is_not_overwritten(self):
+        session = ChatSession.objects.create(user=self.user, turns=self.turns(7))
+
+        def summarized_elsewhere(chat, summary, turns):
+            ChatSession.objects.filter(pk=session.pk).update(summary="other", turns=self.turns(7)[4:])
+            return "summary"
+
+        with self.settings(CHAT_SESSION_KEEP_TURNS=3), mock.patch("rag.sessions.get_chat_model"), \
+                mock.patch("rag.sessions.summarize_history", side_effect=summarized_elsewhere):
+            _fold_old_turns(str(session.pk))
+
+        session.refresh_from_db()
+        self.assertEqual((session.summary, session.turns), ("other", self.turns(7)[4:]))
+
+
+class IngestJobTests(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="rag_test_")
+        self.user = get_user_model().objects.create_user(email="a@example.com", password="x")
+        self.store = LocalVectorStore(self.path, nlist=0)
+        patches = [
+            mock.patch("rag.jobs.get_vector_store", return_value=self.store),
+            mock.patch("rag.jobs.invalidate_rag_app"),
+            mock.patch("rag.jobs.get_answer_cache", return_value=None),
+            mock.patch("utils.loader.embed_documents_cached", side_effect=_fake_embeddings),
+            mock.patch("utils.loader.get_lexical_index", return_value=None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def job(self, **params):
+        return IngestJob.objects.create(
+            user=self.user, source_type="mongodb", collection_name="doc_1", params=params
+        )
+
+    def test_a_job_stores_the_chunks_and_records_the_document(self):
+        job = self.job()
+        docs = [_doc(f"record {i}", source=f"r{i}") for i in range(3)]
+        with mock.patch("rag.jobs._load_docs", return_value=docs):
+            run_ingest_job(job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.stage, job.processed_chunks), (IngestJob.SUCCEEDED, "done", 3))
+        self.assertEqual(len(self.store.collection("doc_1").stored()), 3)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.docs, ["doc_1"])
+
+    def test_a_failed_job_records_the_error_and_removes_its_uploads(self):
+        job = self.job(upload_dir=tempfile.mkdtemp(prefix="rag_upload_"))
+        with mock.patch("rag.jobs._load_docs", side_effect=ValueError("unreadable")):
+            run_ingest_job(job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (IngestJob.FAILED, "unreadable"))
+        self.assertFalse(os.path.exists(job.params["upload_dir"]))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.docs, [])
+
+    def test_status_is_only_shown_to_the_owner(self):
+        job = self.job()
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(f"/rag/jobs/{job.pk}/")
+        self.assertEqual((response.status_code, response.data["status"]), (200, IngestJob.QUEUED))
+
+        client.force_authenticate(get_user_model().objects.create_user(email="b@example.com", password="x"))
+        self.assertEqual(client.get(f"/rag/jobs/{job.pk}/").status_code, 404)
+
+
+class ResumeIngestJobsTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email="a@example.com", password="x")
+
+    def job(self, seconds_since_heartbeat, status=IngestJob.RUNNING):
+        job = IngestJob.objects.create(user=self.user, source_type="api", collection_name="doc", status=status)
+        heartbeat = timezone.now() - timedelta(seconds=seconds_since_heartbeat)
+        IngestJob.objects.filter(pk=job.pk).update(updated_at=heartbeat)
+        return job
+
+    def resume(self, *args):
+        with mock.patch("rag.management.commands.resume_ingest_jobs.run_ingest_job") as run:
+            call_command("resume_ingest_jobs", *args, stdout=io.StringIO(), stderr=io.StringIO())
+        return [call.args[0] for call in run.call_args_list]
+
+    def test_only_jobs_with_an_expired_lease_are_resumed(self):
+        stale = self.job(600)
+        queued = self.job(600, status=IngestJob.QUEUED)
+        self.job(5)
+        self.job(5, status=IngestJob.QUEUED)
+        self.job(600, status=IngestJob.FAILED)
+        self.assertEqual(self.resume("--lease-seconds", "120"), [stale.pk, queued.pk])
+
+    def test_a_claimed_job_is_not_taken_twice(self):
+        self.job(600)
+        self.assertEqual(len(self.resume("--lease-seconds", "120")), 1)
+        # the first run renewed the heartbeat, as the worker it started would
+        self.assertEqual(self.resume("--lease-seconds", "120"), [])
+
+
+class MetricsTests(SimpleTestCase):
+    def test_empty_caches_still_report_stats(self):
+        user = SimpleNamespace(is_authenticated=True, is_staff=True, is_active=True)
+        request = mock.Mock(user=user, method="GET")
+        with mock.patch("rag.views.get_answer_cache", return_value=None), \
+                mock.patch("rag.views.get_retrieval_cache", return_value=TTLCache()), \
+                mock.patch("rag.views.get_reranker", return_value=None), \
+                mock.patch("rag.views.embedding_metrics", return_value={}):
+            data = RAGMetricsView().get(request).data
+        self.assertEqual(data["retrieval_cache"]["entries"], 0)
+        self.assertIsNone(data["answer_cache"])
+
+
+class SemanticAnswerCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = SemanticAnswerCache(threshold=0.9)
+        self.cache.set(101, ["a", "b"], "What is the refund policy?", [1.0, 0.0], "30 days", options={"k": 5})
+
+    def get(self, question="What is the refund policy?", vector=(0.0, 1.0), user_id=101,
+            collections=("a", "b"), options=None):
+        return self.cache.get(user_id, list(collections), question, list(vector), options=options or {"k": 5})
+
+    def test_exact_and_similar_questions_hit(self):
+        self.assertEqual(self.get("  what is the REFUND policy? "), "30 days")
+        self.assertEqual(self.get("How long do refunds take?", vector=(0.95, 0.1)), "30 days")
+        self.assertIsNone(self.get("How do I reset my password?", vector=(0.5, 0.5)))
+        self.assertEqual((self.cache.exact_hits, self.cache.semantic_hits, self.cache.misses), (1, 1, 1))
+
+    def test_entries_are_kept_per_user_collections_and_options(self):
+        self.assertEqual(self.get(collections=("b", "a")), "30 days")
+        self.assertIsNone(self.get(user_id=102))
+        self.assertIsNone(self.get(collections=("a",)))
+        self.assertIsNone(self.get(options={"k": 6}))
+
+    def test_invalidating_a_user_reaches_every_process(self):
+        # another process shares the version table, not the entries
+        SemanticAnswerCache().invalidate_user(101)
+        self.assertIsNone(self.get())
+
+
+def _mock_retriever(embeddings, collection_names=("a",)):
+    """A retriever over one mocked collection that always returns the same chunk."""
+    collection = mock.Mock(metric="cosine")
+    collection.search.return_value = [(_doc("chunk"), 0.1)]
+    store = mock.Mock()
+    store.collection.return_value = collection
+    with mock.patch("utils.genration.get_vector_store", return_value=store), \
+            mock.patch("utils.genration.get_embeddings", return_value=embeddings), \
+            mock.patch("utils.genration.get_lexical_index", return_value=None):
+        return make_user_retriever(list(collection_names)), collection
+
+
+class TTLCacheTests(SimpleTestCase):
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = TTLCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+        self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_entries_expire(self):
+        cache = TTLCache(ttl=10)
+        with mock.patch("utils.cache.time.monotonic", return_value=100.0):
+            cache.set("a", 1)
+        with mock.patch("utils.cache.time.monotonic", return_value=105.0):
+            self.assertEqual(cache.get("a"), 1)
+        with mock.patch("utils.cache.time.monotonic", return_value=111.0):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_invalidate(self):
+        cache = TTLCache()
+        cache.set(("u1", "q"), 1)
+        cache.set(("u2", "q"), 2)
+        cache.invalidate(lambda key: key[0] == "u1")
+        self.assertEqual(cache.items(lambda key: True), [(("u2", "q"), 2)])
+
+
+class RetrievalCacheTests(SimpleTestCase):
+    def test_results_are_cached_until_a_collection_changes(self):
+        embeddings = mock.Mock()
+        embeddings.embed_query.return_value = [1.0, 0.0]
+        retrieve, collection = _mock_retriever(embeddings, ["retrieval_cache_test"])
+        with mock.patch("utils.genration.get_retrieval_cache", return_value=TTLCache()):
+            self.assertEqual(len(retrieve("Refund policy")), 1)
+            self.assertEqual(len(retrieve("refund   POLICY")), 1)
+            self.assertEqual(collection.search.call_count, 1)
+
+            # other options are other results
+            retrieve("refund policy", k=5)
+            self.assertEqual(collection.search.call_count, 2)
+
+            bump_collection_version("retrieval_cache_test")
+            retrieve("refund policy")
+            self.assertEqual(collection.search.call_count, 3)
+
+
+class QueryVectorTests(SimpleTestCase):
+    def test_a_precomputed_vector_is_not_embedded_again(self):
+        embeddings = mock.Mock()
+        retrieve, collection = _mock_retriever(embeddings)
+        with mock.patch("utils.genration.get_retrieval_cache", return_value=None):
+            self.assertEqual(len(retrieve("q", query_vector=[0.5, 0.5])), 1)
+            self.assertEqual(len(asyncio.run(retrieve.aretrieve("q", query_vector=[0.5, 0.5]))), 1)
+        embeddings.embed_query.assert_not_called()
+        self.assertEqual(collection.search.call_args.args[0], [0.5, 0.5])
+
+    def test_turn_state_carries_the_vector_to_the_retriever(self):
+        turn = ChatTurn(SimpleNamespace(id=1, docs=["a"]), {"question": "q", "history": []})
+        self.assertNotIn("query_vector", turn.state())
+        turn.query_vector = [0.5, 0.5]
+        retriever = mock.Mock(return_value=[])
+        make_retrieve_node(retriever)(turn.state())
+        self.assertEqual(retriever.call_args.kwargs["query_vector"], [0.5, 0.5])
+
+
+class _SlowCrossEncoder:
+    """Scores a pair by the number of query words in the chunk, taking `delay` seconds per batch."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.scored = []
+
+    def predict(self, pairs, show_progress_bar=False):
+        time.sleep(self.delay)
+        self.scored.extend(text for _, text in pairs)
+        return [float(sum(word in text.split() for word in query.split())) for query, text in pairs]
+
+
+class RerankerTests(SimpleTestCase):
+    def reranker(self, delay=0.0, budget=5.0):
+        reranker = CrossEncoderReranker("fake", batch_size=1, budget=budget)
+        reranker._model = _SlowCrossEncoder(delay)
+        return reranker
+
+    def docs(self):
+        texts = ["nothing here", "refund", "refund policy", "policy"]
+        return [Document(id=text, page_content=text, metadata={"relevance": 0.5}) for text in texts]
+
+    def test_chunks_are_ordered_by_the_cross_encoder(self):
+        reranker = self.reranker()
+        ranked = reranker.rerank("refund policy", self.docs(), 2)
+        self.assertEqual([doc.page_content for doc in ranked], ["refund policy", "refund"])
+        self.assertEqual(ranked[0].metadata["vector_relevance"], 0.5)
+        self.assertGreater(ranked[0].metadata["relevance"], ranked[1].metadata["relevance"])
+
+        # the scores are cached per question and chunk
+        asyncio.run(reranker.arerank("Refund  policy", self.docs(), 2))
+        self.assertEqual(len(reranker._model.scored), 4)
+        self.assertEqual(reranker.stats()["reranked"], 2)
+
+    def test_the_vector_order_is_kept_past_the_budget(self):
+        for run_async in (False, True):
+            with self.subTest(run_async=run_async):
+                # a fake 100 ms-per-batch model against a 150 ms budget
+                reranker = self.reranker(delay=0.1, budget=0.15)
+                started = time.monotonic()
+                if run_async:
+                    ranked = asyncio.run(reranker.arerank("refund policy", self.docs(), 2))
+                else:
+                    ranked = reranker.rerank("refund policy", self.docs(), 2)
+                self.assertLess(time.monotonic() - started, 0.25)
+                self.assertEqual([doc.page_content for doc in ranked], ["nothing here", "refund"])
+                self.assertEqual(reranker.stats()["timeouts"], 1)
+
+                # the scorer stopped at the deadline instead of finishing the stale request
+                reranker._pool.submit(lambda: None).result()
+                self.assertEqual(len(reranker._model.scored), 2)
+
+
+class CodecTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = unit_rows(rng.normal(size=(300, 64)))
+        self.query = self.vectors[0]
+        self.exact = self.vectors @ self.query
+
+    def similarity(self, codec):
+        codec.fit(self.vectors)
+        codes, scales = codec.encode(self.vectors)
+        return codec.similarity(codec.prepare_query(self.query), codes, scales), codes
+
+    def test_make_codec(self):
+        self.assertEqual(make_codec(None).name, "f32")
+        self.assertEqual(make_codec("INT8").name, "i8")
+        self.assertEqual(make_codec("matryoshka:32").name, "mrl32")
+        self.assertEqual(make_codec("pca:16").name, "pca16")
+        for encoding in ("pca", "matryoshka:x", "float16"):
+            with self.assertRaises(ValueError):
+                make_codec(encoding)
+
+    def test_int8(self):
+        similarity, codes = self.similarity(Int8Codec())
+        self.assertEqual(codes.dtype, np.int8)
+        self.assertLess(np.abs(similarity - self.exact).max(), 0.02)
+
+    def test_binary(self):
+        similarity, codes = self.similarity(BinaryCodec())
+        self.assertEqual(codes.shape, (300, 8))
+        self.assertAlmostEqual(float(similarity[0]), 1.0)
+        self.assertGreater(np.corrcoef(similarity, self.exact)[0, 1], 0.7)
+
+    def test_truncate(self):
+        similarity, codes = self.similarity(TruncateCodec(32))
+        self.assertEqual(codes.shape, (300, 32))
+        self.assertAlmostEqual(float(similarity[0]), 1.0, places=5)
+        self.assertEqual(TruncateCodec(32).decode(codes, None, 64).shape, (300, 64))
+
+    def test_pca_keeps_the_ranking_of_low_rank_data(self):
+        rng = np.random.default_rng(1)
+        self.vectors = unit_rows(rng.normal(size=(300, 8)) @ rng.normal(size=(8, 64)))
+        self.query = self.vectors[0]
+        self.exact = self.vectors @ self.query
+
+        codec = PCACodec(8)
+        self.assertFalse(codec.fitted)
+        similarity, _ = self.similarity(codec)
+
+        self.assertEqual(np.argsort(-similarity)[:5].tolist(), np.argsort(-self.exact)[:5].tolist())
+        restored = PCACodec(8)
+        restored.load_state(codec.state())
+        self.assertTrue(restored.fitted)
+
+
+class LocalCollectionTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="rag_test_")
+        rng = np.random.default_rng(0)
+        self.vectors = rng.normal(size=(200, 32)).astype(np.float32)
+        self.ids = [str(i) for i in range(200)]
+        self.metadatas = [{"source": "s", "doc_id": "a" if i % 2 else "b"} for i in range(200)]
+        self.documents = [f"chunk {i}" for i in range(200)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def collection(self, **options):
+        options.setdefault("nlist", 0)
+        collection = LocalCollection(self.path, "c", **options)
+        collection.upsert(self.ids, self.vectors, self.metadatas, self.documents)
+        return collection
+
+    def nearest(self, collection, index, k=5, where=None):
+        return collection.search(self.vectors[index], k, where=where)
+
+    def test_search_finds_the_stored_vector(self):
+        collection = self.collection()
+        (doc, distance), *rest = self.nearest(collection, 7)
+
+        self.assertEqual((doc.id, doc.page_content, doc.metadata["doc_id"]), ("7", "chunk 7", "a"))
+        self.assertAlmostEqual(distance, 0.0, places=5)
+        self.assertEqual(len(rest), 4)
+        self.assertEqual([distance for _, distance in rest], sorted(distance for _, distance in rest))
+
+    def test_filter_delete_and_reload(self):
+        collection = self.collection()
+        found = self.nearest(collection, 7, k=10, where={"doc_id": "b"})
+        self.assertTrue(found)
+        self.assertTrue(all(doc.metadata["doc_id"] == "b" for doc, _ in found))
+        self.assertEqual(self.nearest(collection, 7, where={"doc_id": {"$in": []}}), [])
+
+        collection.delete(["7"])
+        self.assertNotEqual(self.nearest(collection, 7)[0][0].id, "7")
+        self.assertEqual(len(collection.stored()), 199)
+        self.assertEqual(len(collection.stored("a")), 99)
+
+        # another process (a new instance) sees the same collection
+        reopened = LocalCollection(self.path, "c", nlist=0)
+        self.assertEqual(self.nearest(reopened, 8)[0][0].id, "8")
+        self.assertNotIn("7", reopened.stored())
+
+        batches = list(reopened.iterate(batch_size=50, include_vectors=True))
+        self.assertEqual(sum(len(ids) for ids, *_ in batches), 199)
+        ids, vectors, _, _ = batches[0]
+        np.testing.assert_allclose(vectors, unit_rows(self.vectors[[int(id_) for id_ in ids]]), atol=1e-6)
+
+    def test_upsert_replaces_by_id(self):
+        collection = self.collection()
+        collection.upsert(["7"], self.vectors[8:9], [{"source": "s", "doc_id": "a"}], ["moved"])
+
+        self.assertEqual(len(collection.stored()), 200)
+        self.assertEqual({doc.page_content for doc, _ in self.nearest(collection, 8, k=2)}, {"moved", "chunk 8"})
+
+    def test_freed_slots_are_reused(self):
+        collection = self.collection()
+        size = os.path.getsize(os.path.join(self.path, "vectors.f32"))
+        for i in range(20):
+            # re-ingesting one half of the chunks, then the other, replaces those rows
+            half = slice(0, 100) if i % 2 else slice(100, 200)
+            collection.upsert(self.ids[half], self.vectors[half], self.metadatas[half], self.documents[half])
+        collection.delete(self.ids[:100])
+        collection.upsert(["new"], self.vectors[:1], [{"source": "s", "doc_id": "a"}], ["new"])
+
+        self.assertEqual(os.path.getsize(os.path.join(self.path, "vectors.f32")), size)
+        self.assertEqual(self.nearest(collection, 0)[0][0].id, "new")
+        self.assertEqual(self.nearest(collection, 150)[0][0].id, "150")
+
+        reopened = LocalCollection(self.path, "c", nlist=0)
+        self.assertEqual(self.nearest(reopened, 0)[0][0].id, "new")
+        ids, vectors, _, _ = next(reopened.iterate(batch_size=200, include_vectors=True))
+        self.assertEqual(len(ids), 101)
+        expected = [self.vectors[0] if id_ == "new" else self.vectors[int(id_)] for id_ in ids]
+        np.testing.assert_allclose(vectors, unit_rows(expected), atol=1e-6)
+
+    def test_ivf_lists_still_find_the_stored_vector(self):
+        collection = self.collection(nlist=4, nprobe=2)
+        self.assertIsNotNone(collection._centroids)
+        for index in (0, 50, 199):
+            self.assertEqual(self.nearest(collection, index)[0][0].id, str(index))
+
+    def test_quantized_encodings(self):
+        for encoding in ("int8", "binary", "matryoshka:16"):
+            for rescore in (True, False):
+                with self.subTest(encoding=encoding, rescore=rescore):
+                    shutil.rmtree(self.path, ignore_errors=True)
+                    collection = self.collection(encoding=encoding, rescore=rescore)
+                    self.assertEqual(self.nearest(collection, 3)[0][0].id, "3")
+                    usage = collection.memory_usage()
+                    self.assertEqual(usage["rescore_bytes"], 32 * 4 if rescore else 0)
+
+    def test_encoding_is_fixed_per_collection(self):
+        self.collection(encoding="int8")
+        with self.assertRaises(ValueError):
+            LocalCollection(self.path, "c", encoding="binary").stored()
+        with self.assertRaises(ValueError):
+            LocalCollection(self.path, "d", encoding="pca:8", rescore=False)
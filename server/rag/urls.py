@@ -1,8 +1,16 @@
 from django.urls import path
 from .views import RAGIngestView
 from .views import RAGQueryView  
+from .views import RAGMetricsView
+from .views import RAGJobStatusView
+from .async_views import rag_chat_async, rag_ingest_async
 
 urlpatterns = [
     path("upload/",  RAGIngestView.as_view(), name="rag_ingest"),
-    path("chat/",  RAGQueryView.as_view(), name="rag_chat")  
+    path("chat/",  RAGQueryView.as_view(), name="rag_chat"),
+    path("jobs/<int:job_id>/",  RAGJobStatusView.as_view(), name="rag_job_status"),
+    # same endpoints without blocking a thread per request, for ASGI servers
+    path("async/upload/",  rag_ingest_async, name="rag_ingest_async"),
+    path("async/chat/",  rag_chat_async, name="rag_chat_async"),
+    path("metrics/",  RAGMetricsView.as_view(), name="rag_metrics"),
 ]
\ No newline at end of file
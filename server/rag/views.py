@@ -1,88 +1,161 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.conf import settings
+from django.db import transaction
 import tempfile
 import os
+import json
+import math
+import shutil
+import uuid
 import dotenv
 dotenv.load_dotenv()
-from utils.loader import (
-    get_chroma_client,
-    document_loader,
-    load_from_api,
-    load_from_mongodb,
-    splitter,
-    embedings_store
-)
-from utils.genration import build_rag_app,generation_node, make_user_retriever, make_retrieve_node
-import asyncio
-from rest_framework.permissions import IsAuthenticated
+from utils.api_source import PAGINATION_MODES
+from utils.loader import new_doc_id, validate_text_template
+from rag.jobs import submit_ingest_job
+from rag.models import ChatSession, IngestJob
+from rag.sessions import load_session, record_turn
+from rag.serializer import IngestJobSerializer
+from utils.genration import get_rag_app, stream_generation
+from utils.embeddings import embedding_metrics, get_embeddings
+from utils.cache import get_answer_cache, get_retrieval_cache
+from utils.rerank import get_reranker
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.http import StreamingHttpResponse
-from langchain_google_genai import ChatGoogleGenerativeAI
 
 
 
+def _keep_spooled_upload(uploaded_file, upload_dir):
+    """
+    Hard-links Django's spooled temp file into `upload_dir` so it outlives the request
+    without copying the data; falls back to a copy across filesystems.
+    """
+    original_ext = os.path.splitext(uploaded_file.name)[-1]
+    target = os.path.join(upload_dir, f"{uuid.uuid4().hex}{original_ext}")
+    try:
+        os.link(uploaded_file.temporary_file_path(), target)
+    except OSError:
+        shutil.copyfile(uploaded_file.temporary_file_path(), target)
+    return target
+
+
+class InvalidIngestRequest(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _positive_int(data, key) -> int:
+    try:
+        value = int(data.get(key))
+    except (TypeError, ValueError):
+        value = 0
+    if value < 1:
+        raise InvalidIngestRequest(f"{key} must be a positive integer")
+    return value
+
+
+def _ingest_params(user, data, files):
+    """
+    Validates an upload request and returns (params, staged) for the IngestJob. Shared by
+    the sync and async upload views; raises InvalidIngestRequest.
+    """
+    source_type = data.get("source_type")
+    chroma_collection = data.get("chroma_collection")
+
+    params = {}
+    # re-uploading into one of the user's existing documents only writes what changed
+    if chroma_collection:
+        if chroma_collection not in (user.docs or []):
+            raise InvalidIngestRequest("Unknown chroma_collection", status=404)
+        params["incremental"] = True
+
+    staged = {}
+    if source_type == "file" and files.getlist("doc"):
+        # one or more files (or zip archives) under "doc"; the job removes upload_dir
+        params["upload_dir"] = tempfile.mkdtemp(prefix="rag_upload_")
+        params["files"] = []
+        for idx, uploaded_file in enumerate(files.getlist("doc")):
+            entry = {"name": uploaded_file.name}
+            if hasattr(uploaded_file, "temporary_file_path"):
+                # large uploads are already spooled to disk by Django, keep that file
+                entry["path"] = _keep_spooled_upload(uploaded_file, params["upload_dir"])
+            else:
+                # small uploads are parsed straight from the in-memory buffer
+                entry["staged_key"] = str(idx)
+                staged[entry["staged_key"]] = uploaded_file.read()
+            params["files"].append(entry)
+    elif source_type == "api" and data.get("endpoint_url"):
+        params["endpoint_url"] = data.get("endpoint_url")
+        for key in ("pagination", "items_path", "text_path"):
+            if data.get(key):
+                params[key] = data.get(key)
+        if params.get("pagination") not in (None, *PAGINATION_MODES):
+            raise InvalidIngestRequest(f"pagination must be one of {', '.join(PAGINATION_MODES)}")
+        params["page_options"] = {
+            key: _positive_int(data, key) if key in ("page_size", "max_pages") else data.get(key)
+            for key in ("page_size", "page_param", "size_param", "cursor_path", "max_pages")
+            if data.get(key)
+        }
+    elif source_type == "mongodb" and all(
+        data.get(key) for key in ("mongo_uri", "db_name", "collection_name")
+    ):
+        params["mongo_uri"] = data.get("mongo_uri")
+        params["db_name"] = data.get("db_name")
+        params["collection_name"] = data.get("collection_name")
+        params["query"] = data.get("query", {})
+        for key in ("projection", "text_template"):
+            if data.get(key):
+                params[key] = data.get(key)
+        if params.get("text_template"):
+            try:
+                validate_text_template(params["text_template"])
+            except ValueError as e:
+                raise InvalidIngestRequest(str(e))
+        for key in ("batch_size", "shards"):
+            if data.get(key):
+                params[key] = _positive_int(data, key)
+    else:
+        raise InvalidIngestRequest("Invalid source_type or missing parameters")
+
+    return params, staged
+
+
+def _start_ingest_job(user, data, params, staged) -> IngestJob:
+    job = IngestJob.objects.create(
+        user=user,
+        source_type=data.get("source_type"),
+        params=params,
+        collection_name=data.get("chroma_collection") or new_doc_id()
+    )
+    transaction.on_commit(lambda: submit_ingest_job(job, staged=staged))
+    return job
+
+
+def _ingest_started(job):
+    return {
+        "status": "202",
+        "message": "Ingestion started",
+        "data": {"job_id": job.pk, "collection_name": job.collection_name}
+    }
+
+
 class RAGIngestView(APIView):
     permission_classes = [IsAuthenticated]
     def post(self, request):
         try:
             user= request.user
             print("User payload:", user)
+
             try:
-                asyncio.get_running_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-
-            print(os.getenv("api_key"))
-            print(os.getenv("tenant"))
-
-            source_type = request.data.get("source_type")
-            chroma_collection = request.data.get("chroma_collection")
-
-            client = get_chroma_client(
-                api_key=os.getenv("api_key"),
-                tenant=os.getenv("tenant"),
-                database="Project"
-            )
-
-            if not client:
-                return Response({"status": "500", "message": "Failed to connect to Chroma", "data": {}})
-
-            docs = []
-            if source_type == "file" and "doc" in request.FILES:
-                uploaded_file = request.FILES["doc"]
-
-                original_ext = os.path.splitext(uploaded_file.name)[-1]
-                with tempfile.NamedTemporaryFile(delete=False, suffix=original_ext) as temp_file:
-                    for chunk in uploaded_file.chunks():
-                        temp_file.write(chunk)
-                    temp_file_path = temp_file.name
-
-                docs = document_loader(temp_file_path)
-                os.remove(temp_file_path) 
-            elif source_type == "api":
-                endpoint_url = request.data.get("endpoint_url")
-                docs = load_from_api(endpoint_url)
-            elif source_type == "mongodb":
-                mongo_uri = request.data.get("mongo_uri")
-                db_name = request.data.get("db_name")
-                collection_name = request.data.get("collection_name")
-                query = request.data.get("query", {})
-                docs = load_from_mongodb(mongo_uri, db_name, collection_name, query)
-            else:
-                return Response({"status": "400", "message": "Invalid source_type or missing parameters", "data": {}})
+                params, staged = _ingest_params(user, request.data, request.FILES)
+            except InvalidIngestRequest as e:
+                return Response({"status": str(e.status), "message": str(e), "data": {}}, status=e.status)
 
-            docs = splitter(docs)
-            collection_name = embedings_store(docs, client)
-            user.docs.append(collection_name)
-            user.save()
-            return Response({
-                "status": "200",
-                "message": "Docs processed and embedded successfully",
-                "data": {"collection_name": collection_name}
-            })
+            job = _start_ingest_job(user, request.data, params, staged)
+            return Response(_ingest_started(job), status=202)
 
         except Exception as e:
             print("Error in RAGIngestView:", e)
@@ -90,37 +163,193 @@ class RAGIngestView(APIView):
 
 
 
+def _wants_stream(data, query_params):
+    flag = data.get("stream", query_params.get("stream", False))
+    return str(flag).lower() in ("1", "true", "yes")
+
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _sse_answer_stream(state, tokens, on_answer):
+    """
+    Server-sent events: the retrieved context first, then one event per token, then the
+    final answer merged with whatever `on_answer(answer)` returns (history or session id).
+    """
+    yield _sse_event("context", {"question": state["question"], "context": state["context"]})
+
+    parts = []
+    for token in tokens:
+        parts.append(token)
+        yield _sse_event("token", {"token": token})
+
+    answer = "".join(parts).strip()
+    yield _sse_event("done", {"answer": answer, **on_answer(answer)})
+
+
+def _stream_response(events):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+# turns of a client-posted `history` included in the prompt
+LEGACY_HISTORY_TURNS = 3
+
+
+class ChatTurn:
+    """
+    One question against the user's documents: the conversation it belongs to, the answer
+    cache lookup and the bookkeeping once it is answered. Shared by the sync and async chat
+    views; every method may touch the database or the embedding model.
+    """
+
+    def __init__(self, user, data):
+        self.user = user
+        self.question = data.get("question")
+        self.collections = user.docs or []
+        # Clients either post the whole `history` (legacy) or just a `session_id`, in
+        # which case the conversation is kept server-side and summarized as it grows.
+        self.use_session = "history" not in data
+        self.session_id = data.get("session_id")
+        self.history = data.get("history", [])
+        self.summary = ""
+        self.answer_cache = get_answer_cache()
+        self.query_vector = None
+
+        # optional per-request retrieval overrides
+        self.options = {}
+        self.error = None if self.question else "Question is required"
+        try:
+            if data.get("k"):
+                # every collection and the lexical index are asked for this many candidates
+                self.options["k"] = min(max(int(data.get("k")), 1), getattr(settings, "RETRIEVAL_MAX_K", 20))
+            if data.get("threshold") not in (None, ""):
+                threshold = float(data.get("threshold"))
+                if math.isnan(threshold):
+                    raise ValueError(threshold)
+                self.options["threshold"] = min(max(threshold, 0.0), 1.0)
+        except (TypeError, ValueError):
+            self.error = "k must be an integer and threshold a number"
+
+    def open(self):
+        """Loads the session; raises ChatSession.DoesNotExist for an unknown session_id."""
+        if self.use_session:
+            self.session_id, session = load_session(self.user, self.session_id)
+            self.history, self.summary = session["turns"], session["summary"]
+
+    @property
+    def cacheable(self) -> bool:
+        # a follow-up ("why?", "tell me more") means something else in every conversation
+        return self.answer_cache is not None and not self.history and not self.summary
+
+    def cached_answer(self):
+        if not self.cacheable:
+            return None
+        self.query_vector = get_embeddings().embed_query(self.question)
+        return self.answer_cache.get(
+            self.user.id, self.collections, self.question, self.query_vector, options=self.options
+        )
+
+    def state(self) -> dict:
+        # a session's turns are exactly the ones not yet folded into its summary, so all of
+        # them go into the prompt; client-side histories are cut to the latest turns
+        history = self.history if self.use_session else self.history[-LEGACY_HISTORY_TURNS:]
+        state = {"question": self.question, "history": history, "summary": self.summary, **self.options}
+        if self.query_vector is not None:
+            # embedded for the cache lookup already, retrieval reuses it
+            state["query_vector"] = self.query_vector
+        return state
+
+    def finish(self, answer, context, from_cache=False) -> dict:
+        if self.cacheable and not from_cache and answer and not answer.startswith("Error generating answer"):
+            self.answer_cache.set(self.user.id, self.collections, self.question, self.query_vector, {
+                "context": context,
+                "answer": answer,
+            }, options=self.options)
+        if self.use_session:
+            record_turn(self.session_id, self.question, answer)
+            return {"session_id": self.session_id}
+        return {"history": self.history + [{"q": self.question, "a": answer}]}
+
+
 class RAGQueryView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        question = request.data.get("question")
-        history = request.data.get("history", [])
+        turn = ChatTurn(request.user, request.data)
 
-        if not question:
-            return Response({"error": "Question is required"}, status=400)
+        if turn.error:
+            return Response({"error": turn.error}, status=400)
 
-        user = request.user
-        user_collections = user.docs or []
+        stream = _wants_stream(request.data, request.query_params)
+        try:
+            turn.open()
+        except ChatSession.DoesNotExist:
+            return Response({"error": "Unknown session_id"}, status=404)
 
-        retriever = make_user_retriever(user_collections)
-        chat = ChatGoogleGenerativeAI(
-            model="gemini-1.5",
-            temperature=0,
-            google_api_key=os.getenv("GOOGLE_API_KEY"),
-            disable_streaming=False
-        )
+        cached = turn.cached_answer()
+        if cached is not None:
+            state = {"question": turn.question, "context": cached["context"]}
+            if stream:
+                return _stream_response(_sse_answer_stream(
+                    state,
+                    [cached["answer"]],
+                    on_answer=lambda answer: turn.finish(answer, cached["context"], from_cache=True)
+                ))
+            return Response({
+                "question": turn.question,
+                "context": cached["context"],
+                "answer": cached["answer"],
+                **turn.finish(cached["answer"], cached["context"], from_cache=True),
+                "cached": True,
+            })
+
+        rag_app = get_rag_app(turn.collections, user_id=turn.user.id)
+        state = turn.state()
 
-        retrieve_fn = make_retrieve_node(retriever)
-        state = {"question": question, "history": history}
-        state = retrieve_fn(state)
+        if stream:
+            state = rag_app.retrieve(state)
+            return _stream_response(_sse_answer_stream(
+                state,
+                stream_generation(state, rag_app.chat),
+                on_answer=lambda answer: turn.finish(answer, state["context"])
+            ))
 
-        result = generation_node(state, chat)
+        result = rag_app.graph.invoke(state)
 
         return Response({
-            "question": question,
+            "question": turn.question,
             "context": result["context"],
             "answer": result["answer"],
-            "history": result["history"],  
+            **turn.finish(result["answer"], result["context"]),
         })
 
+
+
+class RAGJobStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        job = IngestJob.objects.filter(pk=job_id, user=request.user).first()
+        if job is None:
+            return Response({"error": "Job not found"}, status=404)
+        return Response(IngestJobSerializer(job).data)
+
+
+
+class RAGMetricsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        answer_cache = get_answer_cache()
+        retrieval_cache = get_retrieval_cache()
+        reranker = get_reranker()
+        return Response({
+            "embeddings": embedding_metrics(),
+            "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+            "retrieval_cache": retrieval_cache.stats() if retrieval_cache is not None else None,
+            "reranker": reranker.stats() if reranker is not None else None,
+        })
@@ -0,0 +1,227 @@
+import os
+import re
+import shelve
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class SourceNotModified(Exception):
+    """The endpoint answered 304, nothing changed since the last ingest."""
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Shared session, so pages reuse pooled keep-alive connections and retry transient errors."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = Retry(
+                    total=getattr(settings, "API_RETRIES", 3),
+                    backoff_factor=0.5,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=["GET"]
+                )
+                adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+_PATH_TOKEN = re.compile(r"\.([^.\[\]]+)|\[(\*|-?\d+)\]|\['([^']+)'\]")
+
+
+def json_path(data, path: str) -> list:
+    """
+    Minimal JSONPath: `$`, `.key`, `['key']`, `[n]` and `[*]`, e.g. `$.data.items[*].title`.
+    Returns every matching value.
+    """
+    if not path or path == "$":
+        return [data]
+    if not path.startswith("$"):
+        path = "$." + path
+
+    matches = [data]
+    for key, index, quoted in _PATH_TOKEN.findall(path[1:]):
+        key = key or quoted
+        found = []
+        for value in matches:
+            if key:
+                if isinstance(value, dict) and key in value:
+                    found.append(value[key])
+            elif index == "*":
+                if isinstance(value, list):
+                    found.extend(value)
+                elif isinstance(value, dict):
+                    found.extend(value.values())
+            elif isinstance(value, list):
+                try:
+                    found.append(value[int(index)])
+                except IndexError:
+                    pass
+        matches = found
+    return matches
+
+
+_validators_lock = threading.Lock()
+
+
+def _open_validators():
+    os.makedirs(os.path.dirname(settings.API_VALIDATOR_CACHE_PATH), exist_ok=True)
+    return shelve.open(settings.API_VALIDATOR_CACHE_PATH)
+
+
+def load_validators(key: str) -> dict:
+    with _validators_lock, _open_validators() as store:
+        return dict(store.get(key, {}))
+
+
+def save_validators(key: str, validators: dict):
+    """Called once an ingest has been stored, so a failed run is never skipped as unchanged."""
+    if not validators:
+        return
+    with _validators_lock, _open_validators() as store:
+        store[key] = validators
+
+
+def _get(url, params=None, headers=None):
+    response = get_http_session().get(
+        url,
+        params=params,
+        headers=headers,
+        timeout=getattr(settings, "API_TIMEOUT", 30)
+    )
+    if response.status_code == 304:
+        raise SourceNotModified(url)
+    response.raise_for_status()
+    return response
+
+
+def _conditional_headers(validators):
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+PAGINATION_MODES = ("none", "link", "cursor", "offset", "page")
+
+
+def fetch_pages(
+    endpoint_url: str,
+    pagination: str = None,
+    items_path: str = None,
+    page_size: int = 100,
+    page_param: str = None,
+    size_param: str = "limit",
+    cursor_path: str = None,
+    max_pages: int = None,
+    concurrency: int = None,
+    validators: dict = None
+):
+    """
+    Yields the items of every page of `endpoint_url`.
+
+    `pagination` is one of None (single request), "link" (follow the Link: next header),
+    "cursor" (read the next cursor at `cursor_path` and send it as `page_param`),
+    "offset" or "page". Offset and page numbers are known up front, so those pages
+    are fetched `concurrency` at a time until a short page comes back.
+
+    `validators` holds the ETag/Last-Modified seen last time; for a single request it is
+    made conditional on them and SourceNotModified is raised on a 304. It is updated in
+    place with the new values. Paginated sources are always fetched in full, since an
+    unchanged first page says nothing about the later ones, and leave it empty.
+    """
+    max_pages = max_pages or getattr(settings, "API_MAX_PAGES", 1000)
+    concurrency = concurrency or getattr(settings, "API_CONCURRENCY", 4)
+
+    def items_of(payload):
+        if items_path:
+            return json_path(payload, items_path)
+        return payload if isinstance(payload, list) else [payload]
+
+    conditional = validators is not None and pagination in (None, "none")
+
+    def first(params=None):
+        response = _get(endpoint_url, params=params, headers=_conditional_headers(validators if conditional else {}))
+        if validators is not None:
+            validators.clear()
+        if conditional:
+            if response.headers.get("ETag"):
+                validators["etag"] = response.headers["ETag"]
+            if response.headers.get("Last-Modified"):
+                validators["last_modified"] = response.headers["Last-Modified"]
+        return response
+
+    if pagination in (None, "none"):
+        yield from items_of(first().json())
+        return
+
+    if pagination == "link":
+        response = first()
+        for _ in range(max_pages):
+            yield from items_of(response.json())
+            next_link = response.links.get("next", {}).get("url")
+            if not next_link:
+                return
+            response = _get(next_link)
+        return
+
+    if pagination == "cursor":
+        page_param = page_param or "cursor"
+        response = first({size_param: page_size})
+        for _ in range(max_pages):
+            payload = response.json()
+            yield from items_of(payload)
+            cursors = json_path(payload, cursor_path or "$.next_cursor")
+            if not cursors or not cursors[0]:
+                return
+            response = _get(endpoint_url, params={size_param: page_size, page_param: cursors[0]})
+        return
+
+    if pagination in ("offset", "page"):
+        page_param = page_param or pagination
+
+        def page_params(number):
+            start = number * page_size if pagination == "offset" else number + 1
+            return {size_param: page_size, page_param: start}
+
+        first_items = items_of(first(page_params(0)).json())
+        yield from first_items
+        if len(first_items) < page_size:
+            return
+
+        def fetch(number):
+            return items_of(_get(endpoint_url, params=page_params(number)).json())
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="api-pages") as pool:
+            number = 1
+            while number < max_pages:
+                wave = range(number, min(number + concurrency, max_pages))
+                for items in pool.map(fetch, wave):
+                    yield from items
+                    if len(items) < page_size:
+                        return
+                number += len(wave)
+        return
+
+    raise ValueError(f"Unknown pagination mode: {pagination}")
+
+
+def item_text(item, text_path: str = None) -> str:
+    if text_path:
+        values = json_path(item, text_path)
+        return "\n".join(str(value) for value in values if value is not None)
+    return str(item)
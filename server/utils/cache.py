@@ -0,0 +1,236 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+
+def normalize_query(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, max_entries=1000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def items(self, predicate):
+        """Live (key, value) pairs whose key matches `predicate`, without touching LRU order."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (key, value) for key, (expires, value) in self._entries.items()
+                if expires >= now and predicate(key)
+            ]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def invalidate(self, predicate):
+        """Drops every entry whose key matches `predicate`."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+class VersionTable:
+    """
+    Counters kept in SQLite, so a write in one process (a server worker, an ingest job, a
+    management command) is seen by every other process on the node at their next read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+    def bump(self, name: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO versions (name, version) VALUES (?, 1)"
+                " ON CONFLICT (name) DO UPDATE SET version = version + 1",
+                (name,)
+            )
+
+    def get(self, names) -> tuple:
+        names = list(names)
+        if not names:
+            return ()
+        with self._lock:
+            rows = dict(self._conn.execute(
+                f"SELECT name, version FROM versions WHERE name IN ({','.join('?' * len(names))})", names
+            ).fetchall())
+        return tuple(rows.get(name, 0) for name in names)
+
+
+_versions = None
+_versions_lock = threading.Lock()
+
+
+def get_version_table() -> VersionTable:
+    global _versions
+    if _versions is None:
+        with _versions_lock:
+            if _versions is None:
+                _versions = VersionTable(settings.CACHE_VERSIONS_PATH)
+    return _versions
+
+
+class SemanticAnswerCache:
+    """
+    Caches answers per (user, collection set, retrieval options). A question is served
+    from the cache when it matches a cached one exactly after normalization, or when its
+    embedding has a cosine similarity of at least `threshold` with a cached question's
+    embedding. Entries also carry the user's version from the shared VersionTable, so
+    `invalidate_user` in any process retires them in every process on the node.
+    """
+
+    def __init__(self, max_entries=1000, ttl=3600, threshold=0.95):
+        self.threshold = threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = TTLCache(max_entries=max_entries, ttl=ttl)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _bucket(user_id, collections, options):
+        version = get_version_table().get([f"user:{user_id}"])[0]
+        return (user_id, version, tuple(sorted(collections)), tuple(sorted((options or {}).items())))
+
+    def get(self, user_id, collections, question, query_vector, options=None):
+        bucket = self._bucket(user_id, collections, options)
+        answer = self._entries.get((*bucket, normalize_query(question)))
+        if answer is not None:
+            with self._lock:
+                self.exact_hits += 1
+            return answer["payload"]
+
+        # nearest neighbour among the bucket's live entries
+        candidates = self._entries.items(lambda key: key[:4] == bucket)
+        if candidates:
+            matrix = np.stack([value["vector"] for _, value in candidates])
+            scores = matrix @ self._unit(query_vector)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                key, value = candidates[best]
+                self._entries.get(key)  # refresh its LRU position
+                with self._lock:
+                    self.semantic_hits += 1
+                return value["payload"]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, user_id, collections, question, query_vector, payload, options=None):
+        key = (*self._bucket(user_id, collections, options), normalize_query(question))
+        self._entries.set(key, {"vector": self._unit(query_vector), "payload": payload})
+
+    def invalidate_user(self, user_id):
+        get_version_table().bump(f"user:{user_id}")
+        self._entries.invalidate(lambda key: key[0] == user_id)
+
+    def stats(self) -> dict:
+        total = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.exact_hits + self.semantic_hits) / total, 3) if total else 0.0,
+        }
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """The process-wide answer cache, or None when ANSWER_CACHE_SIZE is 0."""
+    global _answer_cache
+    if not getattr(settings, "ANSWER_CACHE_SIZE", 0):
+        return None
+    if _answer_cache is None:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                _answer_cache = SemanticAnswerCache(
+                    max_entries=settings.ANSWER_CACHE_SIZE,
+                    ttl=getattr(settings, "ANSWER_CACHE_TTL", 3600),
+                    threshold=getattr(settings, "ANSWER_CACHE_THRESHOLD", 0.95),
+                )
+    return _answer_cache
+
+
+def bump_collection_version(collection_name: str):
+    """Called after every write to a collection so cached retrievals over it go stale."""
+    get_version_table().bump(f"collection:{collection_name}")
+
+
+def collection_versions(collection_names) -> tuple:
+    return get_version_table().get(f"collection:{name}" for name in collection_names)
+
+
+_retrieval_cache = None
+
+
+def get_retrieval_cache():
+    """Process-wide cache of retrieval results, or None when RETRIEVAL_CACHE_SIZE is 0."""
+    global _retrieval_cache
+    if not getattr(settings, "RETRIEVAL_CACHE_SIZE", 0):
+        return None
+    if _retrieval_cache is None:
+        with _answer_cache_lock:
+            if _retrieval_cache is None:
+                _retrieval_cache = TTLCache(
+                    max_entries=settings.RETRIEVAL_CACHE_SIZE,
+                    ttl=getattr(settings, "RETRIEVAL_CACHE_TTL", 600),
+                )
+    return _retrieval_cache
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+import chromadb
+from django.conf import settings
+
+
+class ChromaConnectionManager:
+    """
+    Caches one Chroma client per (tenant, database) and hands it out to every request.
+    Clients are health-checked with a heartbeat at most every `health_check_interval`
+    seconds and rebuilt when the check fails.
+    """
+
+    def __init__(self, backend="cloud", persist_path=None, health_check_interval=30):
+        self.backend = backend
+        self.persist_path = persist_path
+        self.health_check_interval = health_check_interval
+        self._clients = {}
+        self._checked_at = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, api_key, tenant, database):
+        if self.backend == "cloud":
+            return chromadb.CloudClient(api_key=api_key, tenant=tenant, database=database)
+        if self.backend == "persistent":
+            return chromadb.PersistentClient(path=self.persist_path)
+        if self.backend == "memory":
+            return chromadb.EphemeralClient()
+        raise ValueError(f"Unknown Chroma backend: {self.backend}")
+
+    def _is_healthy(self, client):
+        try:
+            client.heartbeat()
+            return True
+        except Exception as e:
+            print(f" Chroma health check failed: {e}")
+            return False
+
+    def get_client(self, api_key=None, tenant=None, database=None):
+        if self.backend != "cloud":
+            # local clients only ever see the default tenant and database
+            tenant, database = None, None
+        tenant = tenant or chromadb.DEFAULT_TENANT
+        database = database or chromadb.DEFAULT_DATABASE
+        key = (tenant, database)
+
+        with self._lock:
+            client = self._clients.get(key)
+            now = time.monotonic()
+            if client is not None and now - self._checked_at[key] < self.health_check_interval:
+                return client
+
+            if client is None or not self._is_healthy(client):
+                client = self._connect(api_key, tenant, database)
+                self._clients[key] = client
+            self._checked_at[key] = now
+            return client
+
+    def reset(self, tenant=None, database=None):
+        with self._lock:
+            if tenant is None and database is None:
+                self._clients.clear()
+                self._checked_at.clear()
+            else:
+                self._clients.pop((tenant, database), None)
+                self._checked_at.pop((tenant, database), None)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_connection_manager() -> ChromaConnectionManager:
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = ChromaConnectionManager(
+                    backend=getattr(settings, "CHROMA_BACKEND", "cloud"),
+                    persist_path=getattr(settings, "CHROMA_PERSIST_PATH", None),
+                    health_check_interval=getattr(settings, "CHROMA_HEALTH_CHECK_INTERVAL", 30),
+                )
+    return _manager
+
+
+def get_default_client():
+    """Returns the pooled client for the tenant/database configured in settings."""
+    return get_connection_manager().get_client(
+        api_key=os.getenv("api_key"),
+        tenant=os.getenv("tenant"),
+        database=getattr(settings, "CHROMA_DATABASE", "Project"),
+    )
+
+
+def vector_layout():
+    return getattr(settings, "VECTOR_LAYOUT", "per_upload")
+
+
+def user_collection_name(user_id):
+    return f"user_{user_id}"
+
+
+def search_targets(doc_ids, user_id=None):
+    """
+    Maps the entries of User.docs to (collection_name, where) pairs to search.
+    With the "per_user" layout every document lives in the user's collection and is
+    selected by its doc_id metadata; otherwise each entry is its own collection.
+    """
+    if not doc_ids:
+        return []
+    if vector_layout() == "per_user" and user_id is not None:
+        return [(user_collection_name(user_id), {"doc_id": {"$in": list(doc_ids)}})]
+    return [(name, None) for name in doc_ids]
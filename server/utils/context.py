@@ -0,0 +1,101 @@
+import math
+
+from django.conf import settings
+
+
+def estimate_tokens(text: str) -> int:
+    """Fast estimate, roughly four characters per token for English text."""
+    return math.ceil(len(text) / 4)
+
+
+def _suffix_prefix_overlap(left: str, right: str, max_overlap=200, min_overlap=20) -> int:
+    for size in range(min(max_overlap, len(left), len(right)), min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+class _Segment:
+    def __init__(self, doc):
+        self.text = doc.page_content
+        self.start = doc.metadata.get("start_index")
+        self.relevance = doc.metadata.get("relevance", 0.0)
+
+    @property
+    def end(self):
+        return self.start + len(self.text)
+
+    def absorb(self, other, overlap):
+        self.text += other.text[overlap:]
+        self.relevance = max(self.relevance, other.relevance)
+
+
+def _merge_source(docs):
+    """Merges the chunks of one source that overlap or touch, in document order."""
+    segments = [_Segment(doc) for doc in docs]
+    positioned = sorted((s for s in segments if s.start is not None), key=lambda s: s.start)
+    unpositioned = [s for s in segments if s.start is None]
+
+    merged = []
+    for segment in positioned:
+        last = merged[-1] if merged else None
+        if last is not None and segment.start <= last.end:
+            if segment.end > last.end:
+                last.absorb(segment, last.end - segment.start)
+            else:
+                last.relevance = max(last.relevance, segment.relevance)
+            continue
+        merged.append(segment)
+
+    # chunks stored without offsets: fall back to matching the splitter overlap in the text
+    for segment in unpositioned:
+        for other in merged:
+            if segment.text in other.text:
+                other.relevance = max(other.relevance, segment.relevance)
+                break
+            overlap = _suffix_prefix_overlap(other.text, segment.text)
+            if overlap:
+                other.absorb(segment, overlap)
+                break
+        else:
+            merged.append(segment)
+    return merged
+
+
+def build_context(docs, token_budget: int = None, separator: str = "\n\n") -> str:
+    """
+    Turns retrieved chunks into the prompt context: duplicate and overlapping chunks of
+    the same source are merged, the passages are ordered by relevance, and the result
+    is cut off at `token_budget` estimated tokens.
+    """
+    if not docs:
+        return ""
+    if token_budget is None:
+        token_budget = getattr(settings, "CONTEXT_TOKEN_BUDGET", 2000)
+
+    # chunks only share offsets within one pre-split document: a page of a file, an API
+    # item ("index") or a MongoDB record ("id")
+    by_source = {}
+    for doc in docs:
+        key = tuple(doc.metadata.get(field) for field in ("doc_id", "source", "page", "index", "id"))
+        by_source.setdefault(key, []).append(doc)
+
+    segments = [segment for group in by_source.values() for segment in _merge_source(group)]
+    segments.sort(key=lambda segment: segment.relevance, reverse=True)
+
+    passages, used = [], 0
+    separator_tokens = estimate_tokens(separator)
+    for segment in segments:
+        remaining = token_budget - used - (separator_tokens if passages else 0)
+        tokens = estimate_tokens(segment.text)
+        if tokens <= remaining:
+            passages.append(segment.text)
+            used += tokens + (separator_tokens if len(passages) > 1 else 0)
+            continue
+        # keep a truncated tail passage only if a meaningful amount of it fits
+        if remaining >= 50:
+            cut = segment.text[:remaining * 4]
+            passages.append(cut[:cut.rfind(" ")] if " " in cut else cut)
+        break
+
+    return separator.join(passages)
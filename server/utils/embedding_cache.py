@@ -0,0 +1,113 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of chunk embeddings keyed by (model name, sha256 of the chunk text).
+    Vectors are stored as float32 blobs in SQLite; once the cache holds more than
+    `max_entries` vectors the least recently used tenth is evicted.
+    """
+
+    def __init__(self, path, max_entries=500_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        # upper bound on the row count, so puts do not have to COUNT(*) every time
+        (self._count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+
+    def get_many(self, model: str, hashes: list[str]) -> dict:
+        """Returns {hash: vector} for the hashes that are cached."""
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            # stay well under SQLite's bound-parameter limit
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                    [model, *batch]
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                    [(now, model, key) for key in found]
+                )
+                self._conn.commit()
+
+            self.hits += sum(1 for key in hashes if key in found)
+            self.misses += sum(1 for key in hashes if key not in found)
+        return found
+
+    def put_many(self, model: str, hashes: list[str], vectors: list[list[float]]):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(model, key, array("f", vector).tobytes(), now) for key, vector in zip(hashes, vectors)]
+            )
+            self._conn.commit()
+            self._count += len(hashes)
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        self._count = count
+        if count <= self.max_entries:
+            return
+        target = int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN ("
+            " SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+            (count - target,)
+        )
+        self._conn.commit()
+        self._count = target
+
+    def sample(self, model: str, limit: int) -> list[list[float]]:
+        """Up to `limit` cached vectors of `model`, most recently used first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT vector FROM embeddings WHERE model = ? ORDER BY last_used DESC LIMIT ?",
+                (model, limit)
+            ).fetchall()
+        return [array("f", blob).tolist() for (blob,) in rows]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
@@ -0,0 +1,141 @@
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from django.conf import settings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from utils.embedding_cache import EmbeddingCache, text_hash
+
+
+_lock = threading.Lock()
+_models = {}
+_metrics = {}
+_cache = None
+
+
+def _model_config():
+    return (
+        getattr(settings, "EMBEDDING_MODEL_NAME", "sentence-transformers/all-mpnet-base-v2"),
+        getattr(settings, "EMBEDDING_DEVICE", "cpu"),
+        getattr(settings, "EMBEDDING_BATCH_SIZE", 32),
+    )
+
+
+def _resident_memory_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if resource is None:
+        return 0.0
+
+    # no procfs, fall back to peak RSS (kilobytes on Linux, bytes on macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss / (1024 * 1024)
+    return rss / 1024
+
+
+def get_embeddings() -> HuggingFaceEmbeddings:
+    """
+    Returns the process-wide embedding model, loading it on first use.
+    Ingest and query share the same instance so the model is only loaded once.
+    """
+    key = _model_config()
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _lock:
+        model = _models.get(key)
+        if model is not None:
+            return model
+
+        model_name, device, batch_size = key
+        rss_before = _resident_memory_mb()
+        started = time.perf_counter()
+        model = HuggingFaceEmbeddings(
+            model_name=model_name,
+            model_kwargs={"device": device},
+            encode_kwargs={"batch_size": batch_size},
+        )
+        load_seconds = time.perf_counter() - started
+
+        _models[key] = model
+        _metrics[model_name] = {
+            "model_name": model_name,
+            "device": device,
+            "batch_size": batch_size,
+            "load_seconds": round(load_seconds, 3),
+            "rss_before_mb": round(rss_before, 1),
+            "rss_after_mb": round(_resident_memory_mb(), 1),
+        }
+        print(f"Loaded embedding model {model_name} on {device} in {load_seconds:.2f}s")
+        return model
+
+
+def get_embedding_cache():
+    """The on-disk chunk embedding cache, or None when EMBEDDING_CACHE_MAX_ENTRIES is 0."""
+    global _cache
+    max_entries = getattr(settings, "EMBEDDING_CACHE_MAX_ENTRIES", 0)
+    if not max_entries:
+        return None
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                _cache = EmbeddingCache(settings.EMBEDDING_CACHE_PATH, max_entries=max_entries)
+    return _cache
+
+
+def embed_documents_cached(texts: list[str]) -> list[list[float]]:
+    """
+    Embeds `texts`, only running the model on chunks that are not already in the
+    embedding cache, so re-uploading a file only pays for the chunks that changed.
+    """
+    embeddings = get_embeddings()
+    cache = get_embedding_cache()
+    if cache is None:
+        return embeddings.embed_documents(texts)
+
+    model_name = _model_config()[0]
+    hashes = [text_hash(text) for text in texts]
+    found = cache.get_many(model_name, hashes)
+
+    missing = {}
+    for key, text in zip(hashes, texts):
+        if key not in found:
+            missing.setdefault(key, text)
+
+    if missing:
+        vectors = embeddings.embed_documents(list(missing.values()))
+        cache.put_many(model_name, list(missing.keys()), vectors)
+        found.update(zip(missing.keys(), vectors))
+
+    return [found[key] for key in hashes]
+
+
+def warm_up_embeddings():
+    """Loads the model and runs one dummy query so the first request does not pay for it."""
+    try:
+        get_embeddings().embed_query("warm up")
+    except Exception as e:
+        print(f"Embedding warm-up failed: {e}")
+
+
+def embedding_metrics() -> dict:
+    cache = get_embedding_cache()
+    return {
+        "models": list(_metrics.values()),
+        "resident_memory_mb": round(_resident_memory_mb(), 1),
+        "cache": cache.stats() if cache is not None else None,
+    }
@@ -11,60 +11,210 @@
 # In[11]:
 
 import os
+import json
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.conf import settings
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
 from langgraph.graph import StateGraph, END
 from typing_extensions import TypedDict
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-import chromadb
-from typing import TypedDict, List, Dict, Any
+from typing import TypedDict, List, Dict, Any, NamedTuple
 from langchain_core.runnables import Runnable
+from langchain_core.documents import Document
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain.callbacks.base import BaseCallbackHandler
 import dotenv
+from utils.embeddings import get_embeddings
+from utils.chroma import search_targets
+from utils.vectorstore import get_vector_store
+from utils.cache import collection_versions, get_retrieval_cache, normalize_query
+from utils.retrieval import DISTANCE_SCALES, reciprocal_rank_fusion, select_relevant
+from utils.lexical import get_lexical_index
+from utils.rerank import get_reranker
+from utils.context import build_context
 dotenv.load_dotenv()
 
 
 # In[12]:
 
 
-SIMILARITY_THRESHOLD = 0.65
+SIMILARITY_THRESHOLD = 0.65  # minimum relevance (cosine similarity), see utils.retrieval
+DEFAULT_K = 3  # chunks handed to the model
 
-def make_user_retriever(collection_names: list[str], k: int = 3):
+_search_pool = ThreadPoolExecutor(
+    max_workers=getattr(settings, "RETRIEVAL_MAX_WORKERS", 8),
+    thread_name_prefix="chroma-search"
+)
+
+
+def _chunk_key(doc):
+    # the same chunk as returned by the vector store and by the lexical index
+    return (doc.metadata.get("doc_id"), doc.metadata.get("source"), doc.page_content)
+
+
+def make_user_retriever(collection_names: list[str], k: int = DEFAULT_K, user_id=None):
     """
-    Returns a retriever that queries across multiple Chroma collections for one user.
-    Filters documents based on a similarity threshold.
+    Returns a retriever that queries across multiple vector collections for one user.
+    The query is embedded once and every collection is searched concurrently; distances
+    are normalized to a common relevance scale and the results are merged into a single
+    top-k above a similarity threshold. Both can be overridden per call.
+    With HYBRID_SEARCH the chunks' BM25 index is searched at the same time and the
+    keyword ranking is fused with the vector ranking (reciprocal rank fusion); the
+    documents' "relevance" is then their fused score relative to the best one.
+    The returned function also has an `aretrieve` coroutine for async callers.
+    `collection_names` are the entries of User.docs; pass `user_id` so the "per_user"
+    layout can resolve them to the user's collection.
     """
     try:
-        cloud_client = chromadb.CloudClient(
-            api_key=os.getenv("api_key"),
-            tenant=os.getenv("tenant"),
-            database="Project"
-        )
+        store = get_vector_store()
+        if store is None:
+            raise RuntimeError("vector store unavailable")
 
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
+        embeddings = get_embeddings()
+        lexical_index = get_lexical_index()
 
         retrievers = []
-
-        for name in collection_names:
-            chroma_client = Chroma(
-                client=cloud_client,
-                collection_name=name,
-                embedding_function=embeddings
+        targets = search_targets(collection_names, user_id)
+        target_names = [name for name, _ in targets]
+        targets_key = tuple((name, json.dumps(where, sort_keys=True)) for name, where in targets)
+
+        for name, where in targets:
+            collection = store.collection(name)
+            retrievers.append((collection, where, DISTANCE_SCALES.get(collection.metric, 0.5)))
+
+        def lookup(query, k, threshold):
+            # follow-up turns and retries of the same question skip the vector search; any
+            # write to one of the collections bumps its version and so changes the key
+            cache = get_retrieval_cache()
+            cache_key = (normalize_query(query), targets_key, collection_versions(target_names), k, threshold)
+            cached = cache.get(cache_key) if cache is not None else None
+            return cache, cache_key, cached
+
+        def candidates_for(k):
+            return max(k, getattr(settings, "HYBRID_CANDIDATES", 20)) if lexical_index else k
+
+        def keyword_search(query, limit):
+            hits = []
+            for name, where in targets:
+                doc_ids = where["doc_id"]["$in"] if where else None
+                hits.extend(lexical_index.search(name, query, limit, doc_ids=doc_ids))
+            hits.sort(key=lambda hit: hit[1], reverse=True)
+            return [
+                Document(id=id_, page_content=text, metadata=metadata)
+                for id_, _, text, metadata in hits[:limit]
+            ]
+
+        def search(query, query_vector, k):
+            futures = {
+                _search_pool.submit(
+                    collection.search,
+                    query_vector,
+                    candidates_for(k),
+                    where
+                ): (collection, scale)
+                for collection, where, scale in retrievers
+            }
+            if lexical_index is not None:
+                futures[_search_pool.submit(keyword_search, query, candidates_for(k))] = (None, None)
+            return futures
+
+        def label(collection):
+            return collection.name if collection is not None else "the lexical index"
+
+        def collect(futures, done, not_done, timeout, k, threshold, cache, cache_key):
+            for future in not_done:
+                future.cancel()
+                print(f" Retrieval from {label(futures[future][0])} timed out after {timeout}s")
+
+            candidates, scales, keyword_hits = [], [], []
+            complete = not not_done
+            for future in done:
+                collection, scale = futures[future]
+                try:
+                    # List of (Document, distance), or Documents for the lexical index
+                    found = future.result()
+                except Exception as e:
+                    complete = False
+                    print(f" Retrieval from {label(collection)} failed: {e}")
+                    continue
+                if collection is None:
+                    keyword_hits = found
+                    continue
+                candidates.extend(found)
+                scales.extend([scale] * len(found))
+
+            ranked = select_relevant(candidates, scales, threshold, candidates_for(k))
+            if lexical_index is not None:
+                ranked = reciprocal_rank_fusion(
+                    [[doc for doc, _ in ranked], keyword_hits],
+                    k,
+                    key=_chunk_key,
+                    rrf_k=getattr(settings, "RRF_K", 60)
+                )
+                best = ranked[0][1] if ranked else 1.0
+                ranked = [(doc, score / best) for doc, score in ranked]
+
+            results = []
+            for doc, relevance in ranked:
+                doc.metadata["relevance"] = relevance
+                results.append(doc)
+            # partial results are not cached, the next attempt may reach every collection
+            if cache is not None and complete:
+                cache.set(cache_key, tuple(results))
+            return results
+
+        def defaults(timeout, threshold):
+            if timeout is None:
+                timeout = getattr(settings, "RETRIEVAL_TIMEOUT", 5.0)
+            if threshold is None:
+                threshold = getattr(settings, "SIMILARITY_THRESHOLD", SIMILARITY_THRESHOLD)
+            return timeout, threshold
+
+        def filtered_retrieve(
+            query: str, timeout: float = None, k: int = k, threshold: float = None, query_vector=None
+        ):
+            # `query_vector` is the question's embedding when the caller already has it
+            if not retrievers:
+                return []
+            timeout, threshold = defaults(timeout, threshold)
+            cache, cache_key, cached = lookup(query, k, threshold)
+            if cached is not None:
+                return list(cached)
+
+            if query_vector is None:
+                query_vector = embeddings.embed_query(query)
+            futures = search(query, query_vector, k)
+            done, not_done = wait(futures, timeout=timeout)
+            return collect(futures, done, not_done, timeout, k, threshold, cache, cache_key)
+
+        async def afiltered_retrieve(
+            query: str, timeout: float = None, k: int = k, threshold: float = None, query_vector=None
+        ):
+            """Same as calling the retriever, but awaits the searches instead of blocking on them."""
+            if not retrievers:
+                return []
+            timeout, threshold = defaults(timeout, threshold)
+            cache, cache_key, cached = lookup(query, k, threshold)
+            if cached is not None:
+                return list(cached)
+
+            if query_vector is None:
+                loop = asyncio.get_running_loop()
+                query_vector = await loop.run_in_executor(_search_pool, embeddings.embed_query, query)
+            futures = search(query, query_vector, k)
+            waiting = {asyncio.wrap_future(future): future for future in futures}
+            done, not_done = await asyncio.wait(waiting, timeout=timeout)
+            return collect(
+                futures,
+                {waiting[future] for future in done},
+                {waiting[future] for future in not_done},
+                timeout, k, threshold, cache, cache_key
             )
-            retrievers.append(chroma_client)  
-
-        def filtered_retrieve(query: str):
-            all_results = []
-            for chroma_client in retrievers:
-                docs_with_scores = chroma_client.similarity_search_with_score(query, k=k)
-                # docs_with_scores -> List of (Document, float_score)
-                for doc, score in docs_with_scores:
-                    if score >= SIMILARITY_THRESHOLD:
-                        all_results.append(doc)
-            return all_results
 
+        filtered_retrieve.aretrieve = afiltered_retrieve
         return filtered_retrieve
 
     except Exception as e:
@@ -77,37 +227,76 @@ def make_user_retriever(collection_names: list[str], k: int = 3):
 
 class RagState(TypedDict):
     question:str
+    documents: List[Document]
     context:str
     answer:str
     history: List[Dict[str, str]]
+    summary: str
+    # the question's embedding, when the answer cache lookup already computed it
+    query_vector: List[float]
 
 
 
-def make_retrieve_node(retriever):
+def _with_context(state: RagState, docs):
+    return {
+        **state,
+        "documents": docs,
+        "context": build_context(docs, token_budget=state.get("token_budget")),
+        "history": state.get("history", [])
+    }
+
+
+def _retrieve_options(state: RagState, candidates: int = None):
+    options = {key: state[key] for key in ("k", "threshold", "query_vector") if state.get(key) is not None}
+    if candidates:
+        # the rerank node narrows these down to k again
+        options["k"] = max(options.get("k", DEFAULT_K), candidates)
+    return options
+
+
+def make_retrieve_node(retriever, candidates: int = None):
     def retrieve_node(state: RagState):
-        query = state["question"]
-        docs = retriever(query) if retriever else []
-        context = "\n\n".join([doc.page_content for doc in docs]) if docs else ""
-
-        return {
-            "context": context,
-            "question": state["question"],
-            "history": state.get("history", [])  
-        }
+        docs = retriever(state["question"], **_retrieve_options(state, candidates)) if retriever else []
+        return _with_context(state, docs)
     return retrieve_node
 
 
+def make_aretrieve_node(retriever, candidates: int = None):
+    async def aretrieve_node(state: RagState):
+        docs = (
+            await retriever.aretrieve(state["question"], **_retrieve_options(state, candidates))
+            if retriever else []
+        )
+        return _with_context(state, docs)
+    return aretrieve_node
+
+
+def make_rerank_node(reranker):
+    """Re-orders the retrieved `documents` with the cross-encoder and rebuilds the context."""
+    def rerank_node(state: RagState):
+        docs = reranker.rerank(state["question"], state.get("documents", []), state.get("k") or DEFAULT_K)
+        return _with_context(state, docs)
+    return rerank_node
+
+
+def make_arerank_node(reranker):
+    async def arerank_node(state: RagState):
+        docs = await reranker.arerank(state["question"], state.get("documents", []), state.get("k") or DEFAULT_K)
+        return _with_context(state, docs)
+    return arerank_node
+
+
 # In[48]:
 
 
-def generation_node(state: RagState, chat):
+def build_prompt_messages(state: RagState):
     context = state["context"]
     question = state["question"]
+    # callers pass only the turns the prompt should see (see ChatTurn.state)
     history = state.get("history", [])
-    recent_history = history[-3:]
 
     history_text = "\n".join(
-        [f"Human: {h['q']}\nAI: {h['a']}" for h in recent_history]
+        [f"Human: {h['q']}\nAI: {h['a']}" for h in history]
     )
 
     system_prompt = (
@@ -117,6 +306,10 @@ def generation_node(state: RagState, chat):
         "Always provide the most accurate, clear, and factual answer."
     )
 
+    summary = state.get("summary")
+    if summary:
+        history_text = f"(Summary of earlier conversation: {summary})\n{history_text}"
+
     human_prompt = f"""
 Conversation so far:
 {history_text}
@@ -128,16 +321,40 @@ Question:
 {question}
 """
 
-    answer = ""
+    return [
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=human_prompt)
+    ]
+
+
+def stream_generation(state: RagState, chat):
+    """Yields answer tokens as the model produces them."""
     try:
-        for chunk in chat.stream([
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=human_prompt)
-        ]):
+        for chunk in chat.stream(build_prompt_messages(state)):
             token = chunk.content or ""
-            answer += token
+            if token:
+                yield token
     except Exception as e:
-        answer = f"Error generating answer: {e}"
+        yield f"Error generating answer: {e}"
+
+
+async def astream_generation(state: RagState, chat):
+    """Async variant of stream_generation, awaiting the model instead of holding a thread."""
+    try:
+        async for chunk in chat.astream(build_prompt_messages(state)):
+            token = chunk.content or ""
+            if token:
+                yield token
+    except Exception as e:
+        yield f"Error generating answer: {e}"
+
+
+def generation_node(state: RagState, chat):
+    context = state["context"]
+    question = state["question"]
+    history = state.get("history", [])
+
+    answer = "".join(stream_generation(state, chat))
 
     new_history = history + [{"q": question, "a": answer}]
 
@@ -149,6 +366,20 @@ Question:
     }
 
 
+def summarize_history(chat, summary: str, turns: List[Dict[str, str]]) -> str:
+    """Folds `turns` into the running conversation `summary` and returns the new summary."""
+    turns_text = "\n".join(f"Human: {t['q']}\nAI: {t['a']}" for t in turns)
+    response = chat.invoke([
+        SystemMessage(content=(
+            "You maintain a running summary of a conversation. "
+            "Merge the new exchanges into the existing summary. Keep facts, names, numbers "
+            "and open questions; drop pleasantries. Answer with the summary only, at most 200 words."
+        )),
+        HumanMessage(content=f"Existing summary:\n{summary or 'None'}\n\nNew exchanges:\n{turns_text}")
+    ])
+    return (response.content or "").strip()
+
+
 # In[49]:
 
 class TokenCaptureCallback(BaseCallbackHandler):
@@ -163,24 +394,116 @@ class TokenCaptureCallback(BaseCallbackHandler):
 # In[50]:
 
 
-def build_rag_app(user_collections: List[str]):
-    retriever = make_user_retriever(user_collections)
+_chat = None
+_chat_lock = threading.Lock()
 
-    chat = ChatGoogleGenerativeAI(
-        model="gemini-1.5-flash",
-        temperature=0,
-        disable_streaming=False,
-        google_api_key=os.getenv("GOOGLE_API_KEY")
-    )
+
+def get_chat_model():
+    """The Gemini client is stateless, so every graph shares one instance."""
+    global _chat
+    if _chat is None:
+        with _chat_lock:
+            if _chat is None:
+                _chat = ChatGoogleGenerativeAI(
+                    model=getattr(settings, "GEMINI_MODEL", "gemini-1.5-flash"),
+                    temperature=0,
+                    disable_streaming=False,
+                    google_api_key=os.getenv("GOOGLE_API_KEY")
+                )
+    return _chat
+
+
+class RagApp(NamedTuple):
+    graph: Any
+    retriever: Any
+    retrieve: Any
+    aretrieve: Any
+    chat: Any
+
+
+def build_rag_app(user_collections: List[str], user_id=None) -> RagApp:
+    retriever = make_user_retriever(user_collections, user_id=user_id)
+    reranker = get_reranker()
+    candidates = getattr(settings, "RERANK_CANDIDATES", 10) if reranker is not None else None
+    retrieve_fn = make_retrieve_node(retriever, candidates)
+    aretrieve_fn = make_aretrieve_node(retriever, candidates)
+
+    chat = get_chat_model()
 
     graph = StateGraph(dict)  
-    graph.add_node("retrieve", make_retrieve_node(retriever))
+    graph.add_node("retrieve", retrieve_fn)
     graph.add_node("generate", lambda s: generation_node(s, chat))
     graph.set_entry_point("retrieve")
-    graph.add_edge("retrieve", "generate")
+    if reranker is not None:
+        rerank_fn = make_rerank_node(reranker)
+        arerank_fn = make_arerank_node(reranker)
+        graph.add_node("rerank", rerank_fn)
+        graph.add_edge("retrieve", "rerank")
+        graph.add_edge("rerank", "generate")
+
+        # the streaming paths run everything up to generation themselves
+        def prepare(state):
+            return rerank_fn(retrieve_fn(state))
+
+        async def aprepare(state):
+            return await arerank_fn(await aretrieve_fn(state))
+    else:
+        graph.add_edge("retrieve", "generate")
+        prepare, aprepare = retrieve_fn, aretrieve_fn
     graph.add_edge("generate", END)
 
-    return graph, chat
+    return RagApp(
+        graph=graph.compile(),
+        retriever=retriever,
+        retrieve=prepare,
+        aretrieve=aprepare,
+        chat=chat
+    )
+
+
+_app_cache = OrderedDict()
+_app_keys = {}
+_app_cache_lock = threading.Lock()
+
+
+def get_rag_app(user_collections: List[str], user_id=None) -> RagApp:
+    """
+    Returns the compiled graph for this collection set from an LRU cache.
+    A change to User.docs produces a new key and drops the user's previous entry;
+    a reconnected Chroma client (a new vector store) also forces a rebuild.
+    """
+    key = (user_id, tuple(user_collections))
+    client_id = id(get_vector_store())
+
+    with _app_cache_lock:
+        entry = _app_cache.get(key)
+        if entry is not None and entry[0] == client_id:
+            _app_cache.move_to_end(key)
+            return entry[1]
+
+    app = build_rag_app(user_collections, user_id=user_id)
+    if app.retriever is None:
+        # connecting failed, try again on the next request rather than caching a blind graph
+        return app
+
+    with _app_cache_lock:
+        stale_key = _app_keys.get(user_id)
+        if stale_key is not None and stale_key != key:
+            _app_cache.pop(stale_key, None)
+        _app_cache[key] = (client_id, app)
+        _app_keys[user_id] = key
+        while len(_app_cache) > getattr(settings, "RAG_APP_CACHE_SIZE", 256):
+            evicted_key, _ = _app_cache.popitem(last=False)
+            if _app_keys.get(evicted_key[0]) == evicted_key:
+                del _app_keys[evicted_key[0]]
+    return app
+
+
+def invalidate_rag_app(user_id):
+    with _app_cache_lock:
+        key = _app_keys.pop(user_id, None)
+        if key is not None:
+            _app_cache.pop(key, None)
 
 
 # In[51]:
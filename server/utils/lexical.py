@@ -0,0 +1,193 @@
+import heapq
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+
+from django.conf import settings
+
+from utils.cache import collection_versions
+
+_TOKEN = re.compile(r"\w+(?:[-./:]\w+)*")
+_TOKEN_PARTS = re.compile(r"[-./:]")
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lowercased words. Identifiers such as `ERR-0042`, `v2.3.1` or `ns:key` are kept whole
+    and also split into their parts, so both the exact code and its pieces match.
+    """
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        tokens.append(token)
+        parts = _TOKEN_PARTS.split(token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over the chunks of each vector collection, stored in SQLite so it
+    survives restarts and is shared by every process on the node. It is written next to
+    the vector store by `embedings_store`, with the same chunk ids.
+    """
+
+    def __init__(self, path, k1=1.2, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._stats = {}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " collection TEXT NOT NULL,"
+            " id TEXT NOT NULL,"
+            " doc_id TEXT,"
+            " length INTEGER NOT NULL,"
+            " text TEXT NOT NULL,"
+            " metadata TEXT NOT NULL,"
+            " PRIMARY KEY (collection, id))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " collection TEXT NOT NULL,"
+            " term TEXT NOT NULL,"
+            " id TEXT NOT NULL,"
+            " tf INTEGER NOT NULL,"
+            " PRIMARY KEY (collection, term, id)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_chunk ON postings (collection, id)")
+        self._conn.commit()
+
+    def _delete(self, collection, ids):
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            self._conn.execute(
+                f"DELETE FROM postings WHERE collection = ? AND id IN ({placeholders})", [collection, *batch]
+            )
+            self._conn.execute(
+                f"DELETE FROM chunks WHERE collection = ? AND id IN ({placeholders})", [collection, *batch]
+            )
+
+    def add(self, collection: str, ids: list[str], texts: list[str], metadatas: list[dict]):
+        """Indexes the chunks, replacing any already indexed under the same ids."""
+        chunks, postings = [], []
+        for id_, text, metadata in zip(ids, texts, metadatas):
+            counts = Counter(tokenize(text))
+            chunks.append((
+                collection, id_, metadata.get("doc_id"), sum(counts.values()), text, json.dumps(metadata)
+            ))
+            postings.extend((collection, term, id_, tf) for term, tf in counts.items())
+
+        with self._lock:
+            self._delete(collection, ids)
+            self._conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?)", chunks)
+            self._conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)", postings)
+            self._conn.commit()
+            self._stats.pop(collection, None)
+
+    def delete(self, collection: str, ids: list[str]):
+        with self._lock:
+            self._delete(collection, ids)
+            self._conn.commit()
+            self._stats.pop(collection, None)
+
+    def drop(self, collection: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM postings WHERE collection = ?", (collection,))
+            self._conn.execute("DELETE FROM chunks WHERE collection = ?", (collection,))
+            self._conn.commit()
+            self._stats.pop(collection, None)
+
+    def _collection_stats(self, collection):
+        # (chunk count, total length), cached per collection version: other processes write
+        # to the same index, and every writer bumps the shared version once it has written
+        version = collection_versions([collection])[0]
+        cached = self._stats.get(collection)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        stats = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks WHERE collection = ?", (collection,)
+        ).fetchone()
+        self._stats[collection] = (version, stats)
+        return stats
+
+    def search(self, collection: str, query: str, k: int, doc_ids=None) -> list[tuple]:
+        """
+        Returns up to `k` (id, score, text, metadata) tuples, best BM25 score first.
+        `doc_ids` restricts the results to chunks of those documents.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        allowed = set(doc_ids) if doc_ids is not None else None
+
+        with self._lock:
+            count, total = self._collection_stats(collection)
+            if not count or not terms or k <= 0:
+                return []
+            average_length = total / count
+
+            frequencies = {
+                term: self._conn.execute(
+                    "SELECT COUNT(*) FROM postings WHERE collection = ? AND term = ?", (collection, term)
+                ).fetchone()[0]
+                for term in terms
+            }
+            # terms found in most chunks add almost nothing to the score but cost a scan
+            # of most postings, so they only count when nothing rarer matched
+            terms = (
+                [term for term in terms if 0 < frequencies[term] <= count / 2]
+                or [term for term in terms if frequencies[term]]
+            )
+
+            scores = {}
+            for term in terms:
+                rows = self._conn.execute(
+                    "SELECT p.id, p.tf, c.length, c.doc_id FROM postings p"
+                    " JOIN chunks c ON c.collection = p.collection AND c.id = p.id"
+                    " WHERE p.collection = ? AND p.term = ?",
+                    (collection, term)
+                ).fetchall()
+                df = frequencies[term]
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                for id_, tf, length, doc_id in rows:
+                    if allowed is not None and doc_id not in allowed:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                    scores[id_] = scores.get(id_, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            if not best:
+                return []
+            placeholders = ",".join("?" * len(best))
+            rows = self._conn.execute(
+                f"SELECT id, text, metadata FROM chunks WHERE collection = ? AND id IN ({placeholders})",
+                [collection, *(id_ for id_, _ in best)]
+            ).fetchall()
+
+        found = {id_: (text, json.loads(metadata)) for id_, text, metadata in rows}
+        return [(id_, score, *found[id_]) for id_, score in best if id_ in found]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_lexical_index():
+    """The node's lexical index, or None when HYBRID_SEARCH is off."""
+    global _index
+    if not getattr(settings, "HYBRID_SEARCH", False):
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = LexicalIndex(settings.LEXICAL_INDEX_PATH)
+    return _index
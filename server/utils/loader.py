@@ -14,17 +14,33 @@ dotenv.load_dotenv()
 
 
 import docx2txt
-import requests
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
-from typing import List
+from pypdf import PdfReader
+from typing import Iterable, Iterator, List
 from langchain.schema import Document
 from pymongo import MongoClient
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
 import os
+import re
 import uuid
-import chromadb
+import hashlib
+import queue
+import threading
+import io
+import mmap
+import multiprocessing
+import shutil
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from itertools import islice
+from django.conf import settings
+from utils.embeddings import embed_documents_cached
+from utils.cache import bump_collection_version
+from utils.chroma import get_connection_manager, user_collection_name, vector_layout
+from utils.api_source import SourceNotModified, fetch_pages, item_text
+from utils.lexical import get_lexical_index
+from utils.vectorstore import as_vector_store
 
 
 # In[16]:
@@ -32,57 +48,206 @@ import chromadb
 
 def get_chroma_client(api_key: str, tenant: str, database: str):
     try:
-        client = chromadb.CloudClient(
+        client = get_connection_manager().get_client(
             api_key=api_key,
             tenant=tenant,
             database=database
         )
-        print("Successfully connected to Chroma Cloud!")
         return client
     except Exception as e:
-        print(f" Error connecting to Chroma Cloud: {e}")
+        print(f" Error connecting to Chroma: {e}")
         return None
 
 
 # In[17]:
 
 
-def document_loader(file_path:str)-> List[Document]:
-    ext=os.path.splitext(file_path)[-1].lower()
+SUPPORTED_EXTENSIONS = (".pdf", ".docx", ".txt")
+
+
+@contextmanager
+def _open_binary(source):
+    """Yields a readable binary stream for a path, bytes or an already open file object."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield io.BytesIO(source)
+    elif isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size and size >= getattr(settings, "INGEST_MMAP_THRESHOLD_MB", 8) * 1024 * 1024:
+                # large files are paged in by the OS instead of being read up front
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    yield mapped
+            else:
+                yield f
+    else:
+        if hasattr(source, "seek"):
+            source.seek(0)
+        yield source
+
+
+def _load_pdf(stream, name):
+    reader = PdfReader(stream)
+    total_pages = len(reader.pages)
+    return [
+        Document(
+            page_content=page.extract_text() or "",
+            metadata={"source": name, "page": idx, "total_pages": total_pages}
+        )
+        for idx, page in enumerate(reader.pages)
+    ]
+
+
+def _decode_text(data: bytes) -> str:
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+
+def document_loader(file_path, file_name: str = None)-> List[Document]:
+    """
+    Loads a PDF, DOCX or TXT file. `file_path` may be a path, the raw bytes, or a binary
+    file object (e.g. a Django upload); for the last two `file_name` supplies the
+    extension and the source recorded on every page.
+    """
+    name = file_name or (str(file_path) if isinstance(file_path, (str, os.PathLike)) else "unknown")
+    ext=os.path.splitext(name)[-1].lower()
     try:
-        if ext==".pdf":
-            loader = PyPDFLoader(file_path)
-        elif ext==".docx":
-            loader=Docx2txtLoader(file_path)
-        elif ext==".txt":
-            loader=TextLoader(file_path)
-        else:
-            print(f"Skipping unsupported file: {file_path}")
+        if ext not in SUPPORTED_EXTENSIONS:
+            print(f"Skipping unsupported file: {name}")
             return None
-        return loader.load()
+        with _open_binary(file_path) as stream:
+            if ext==".pdf":
+                return _load_pdf(stream, name)
+            if ext==".docx":
+                text = docx2txt.process(stream)
+            else:
+                text = _decode_text(stream.read())
+        return [Document(page_content=text, metadata={"source": name})]
     except Exception as e:
-        print(f"Error loading {file_path}: {e}")
+        print(f"Error loading {name}: {e}")
         return None
 
 
+def _parse_file(source, name: str):
+    """Runs in a parse worker process: loads one file from its path or bytes."""
+    started = time.perf_counter()
+    docs = document_loader(source, name)
+    return docs, time.perf_counter() - started
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """PDF parsing is CPU-bound, so files are parsed in a pool of worker processes."""
+    global _parse_pool
+    if _parse_pool is None:
+        with _parse_pool_lock:
+            if _parse_pool is None:
+                _parse_pool = ProcessPoolExecutor(
+                    max_workers=getattr(settings, "INGEST_PARSE_PROCESSES", None) or None,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+    return _parse_pool
+
+
+def expand_uploads(files, work_dir: str):
+    """
+    Yields (source, name) for every upload, where source is a path or the file's bytes,
+    expanding zip archives into their supported members. Members small enough for
+    FILE_UPLOAD_MAX_MEMORY_SIZE stay in memory, larger ones are extracted into
+    `work_dir`. Member names are only used as labels, never as paths.
+    """
+    in_memory_limit = getattr(settings, "FILE_UPLOAD_MAX_MEMORY_SIZE", 2621440)
+    for source, name in files:
+        if not name.lower().endswith(".zip"):
+            yield source, name
+            continue
+
+        with _open_binary(source) as stream, zipfile.ZipFile(stream) as archive:
+            max_bytes = getattr(settings, "INGEST_MAX_ARCHIVE_MB", 1024) * 1024 * 1024
+            if sum(member.file_size for member in archive.infolist()) > max_bytes:
+                raise ValueError(f"{name} expands to more than {max_bytes // (1024 * 1024)} MB")
+            for member in archive.infolist():
+                ext = os.path.splitext(member.filename)[-1].lower()
+                if member.is_dir() or ext not in SUPPORTED_EXTENSIONS:
+                    continue
+                if member.file_size <= in_memory_limit:
+                    yield archive.read(member), f"{name}/{member.filename}"
+                    continue
+                target = os.path.join(work_dir, f"{uuid.uuid4().hex}{ext}")
+                with archive.open(member) as src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                yield target, f"{name}/{member.filename}"
+
+
+def load_files(files, report=None) -> Iterator[Document]:
+    """
+    Parses (source, name) pairs in the parse pool and yields their documents as each file
+    finishes, so splitting and embedding start before the slowest file is done.
+    `report(name, result)` receives the status, page count and parse time of every file.
+    """
+    futures = {}
+    for source, name in files:
+        if os.path.splitext(name)[-1].lower() not in SUPPORTED_EXTENSIONS:
+            if report:
+                report(name, {"status": "skipped", "error": "unsupported file type"})
+            continue
+        futures[get_parse_pool().submit(_parse_file, source, name)] = name
+
+    for future in as_completed(futures):
+        name = futures[future]
+        try:
+            docs, seconds = future.result()
+        except Exception as e:
+            docs, seconds = None, 0.0
+            print(f"Error loading {name}: {e}")
+
+        if report:
+            if docs:
+                report(name, {"status": "ok", "pages": len(docs), "seconds": round(seconds, 3)})
+            else:
+                report(name, {"status": "failed", "error": "could not be parsed", "seconds": round(seconds, 3)})
+        yield from docs or []
+
+
 # In[18]:
 
 
-def load_from_api(endpoint_url: str):
+def load_from_api(
+    endpoint_url: str,
+    pagination: str = None,
+    items_path: str = None,
+    text_path: str = None,
+    validators: dict = None,
+    **page_options
+) -> List[Document]:
+    """
+    Loads every item of a JSON endpoint, following `pagination` (see `fetch_pages`).
+    `items_path` picks the list of items out of each page and `text_path` the text
+    fields of each item, both as JSONPath; by default the whole item is stringified.
+    Raises SourceNotModified when `validators` show the endpoint is unchanged.
+    """
     try:
-        response = requests.get(endpoint_url)
-        response.raise_for_status()
-        data = response.json()  
+        items = fetch_pages(
+            endpoint_url,
+            pagination=pagination,
+            items_path=items_path,
+            validators=validators,
+            **page_options
+        )
+        documents = []
+        for idx, item in enumerate(items):
+            documents.append(Document(
+                page_content=item_text(item, text_path),
+                metadata={"source": endpoint_url, "index": idx}
+            ))
+    except SourceNotModified:
+        raise
     except Exception as e:
-        print(f"Error fetching data: {e}")
-        return []
-
-    documents = []
-    if isinstance(data, list):
-        for idx, item in enumerate(data):
-            documents.append(Document(page_content=str(item), metadata={"source": endpoint_url, "index": idx}))
-    else:
-        documents.append(Document(page_content=str(data), metadata={"source": endpoint_url}))
+        raise RuntimeError(f"Error fetching data: {e}")
 
     return documents
 
@@ -90,74 +255,341 @@ def load_from_api(endpoint_url: str):
 # In[19]:
 
 
-def load_from_mongodb(connection_uri: str, db_name: str, collection_name: str, query: dict = {}):
-    docs = []
-    try:
-        client = MongoClient(connection_uri)
-        collection = client[db_name][collection_name]
-        results = collection.find(query)
+_mongo_clients = {}
+_mongo_lock = threading.Lock()
+
+
+def get_mongo_client(connection_uri: str) -> MongoClient:
+    """MongoClient keeps its own connection pool, so one client per URI is shared by every ingest."""
+    with _mongo_lock:
+        client = _mongo_clients.get(connection_uri)
+        if client is None:
+            client = MongoClient(connection_uri)
+            _mongo_clients[connection_uri] = client
+        return client
 
-        for r in results:
-            docs.append(Document(page_content=str(r), metadata={"collection": collection_name}))
-    except Exception as e:
-        print(f"MongoDB error: {e}")
 
-    return docs
+# `{field}`, or `{{`/`}}` for literal braces; deliberately not str.format, whose
+# `{a.b}`/`{a[b]}` lookups would let a request template walk into Python objects
+_TEMPLATE_TOKEN = re.compile(r"\{\{|\}\}|\{(\w+)\}")
 
 
+def validate_text_template(text_template: str):
+    """Raises ValueError unless every `{...}` in the template is a plain field name."""
+    remainder = _TEMPLATE_TOKEN.sub("", text_template)
+    if "{" in remainder or "}" in remainder:
+        raise ValueError("text_template fields must be plain {field} names")
 
 
-def splitter(docs: List[Document], chunk_size=500, chunk_overlap=100):
+def _render_mongo_doc(record: dict, text_template: str = None) -> str:
+    if text_template:
+        return _TEMPLATE_TOKEN.sub(
+            lambda match: str(record.get(match.group(1), "")) if match.group(1) else match.group(0)[0],
+            text_template
+        )
+    return "\n".join(f"{key}: {value}" for key, value in record.items() if key != "_id")
+
+
+def _mongo_id_ranges(collection, query: dict, shards: int, warn=None):
+    """
+    Splits the matching documents into roughly equal `_id` ranges, one per worker.
+    $bucketAuto sorts the whole matching set, so it may spill to disk on large collections.
+    """
+    if shards <= 1:
+        return [None]
+    try:
+        buckets = list(collection.aggregate([
+            {"$match": query},
+            {"$bucketAuto": {"groupBy": "$_id", "buckets": shards}}
+        ], allowDiskUse=True))
+    except Exception as e:
+        message = f"MongoDB sharding unavailable, reading with a single cursor: {e}"
+        print(message)
+        if warn:
+            warn(message)
+        return [None]
+    if not buckets:
+        return [None]
+
+    ranges = []
+    for idx, bucket in enumerate(buckets):
+        bounds = bucket["_id"]
+        # bucket maxima are exclusive, except for the last bucket
+        upper = "$lte" if idx == len(buckets) - 1 else "$lt"
+        ranges.append({"$gte": bounds["min"], upper: bounds["max"]})
+    return ranges
+
+
+def load_from_mongodb(
+    connection_uri: str,
+    db_name: str,
+    collection_name: str,
+    query: dict = {},
+    projection=None,
+    text_template: str = None,
+    batch_size: int = None,
+    shards: int = None,
+    client=None,
+    warn=None
+) -> Iterator[Document]:
+    """
+    Streams the matching documents without holding the result set in memory.
+    The collection is split into `_id` ranges that are read concurrently, `batch_size`
+    records per round trip; only the `projection` fields are fetched and each record
+    is rendered with `text_template` (plain `{field}` names, missing ones render empty).
+    Pass `client` to read through an existing (or mongomock) client; `warn(message)`
+    is told when the collection can not be split and is read with a single cursor.
+    """
+    batch_size = batch_size or getattr(settings, "MONGO_BATCH_SIZE", 1000)
+    shards = shards or getattr(settings, "MONGO_SHARDS", 4)
+    query = query or {}
+    if text_template:
+        validate_text_template(text_template)
+
+    try:
+        client = client or get_mongo_client(connection_uri)
+        collection = client[db_name][collection_name]
+        ranges = _mongo_id_ranges(collection, query, shards, warn=warn)
+    except Exception as e:
+        raise RuntimeError(f"MongoDB error: {e}")
+
+    # bounded, so slow embedding applies backpressure to the readers
+    records = queue.Queue(maxsize=batch_size * 2)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                records.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def read(id_range):
+        try:
+            shard_query = query if id_range is None else {"$and": [query, {"_id": id_range}]}
+            for record in collection.find(shard_query, projection, batch_size=batch_size):
+                if stop.is_set():
+                    break
+                put(record)
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    readers = [
+        threading.Thread(target=read, args=(id_range,), name=f"mongo-shard-{idx}", daemon=True)
+        for idx, id_range in enumerate(ranges)
+    ]
+    for reader in readers:
+        reader.start()
+
+    source = f"mongodb/{db_name}/{collection_name}"
+    finished = 0
+    try:
+        while finished < len(readers):
+            record = records.get()
+            if record is done:
+                finished += 1
+                continue
+            if isinstance(record, Exception):
+                raise RuntimeError(f"MongoDB error: {record}")
+            yield Document(
+                page_content=_render_mongo_doc(record, text_template),
+                metadata={"collection": collection_name, "source": source, "id": str(record.get("_id"))}
+            )
+    finally:
+        stop.set()
+
+
+
+
+def _clean_metadata(metadata: dict) -> dict:
+    """Chroma only stores str/int/float/bool metadata values."""
+    cleaned = {}
+    for key, value in (metadata or {}).items():
+        if value is None:
+            continue
+        cleaned[key] = value if isinstance(value, (str, int, float, bool)) else str(value)
+    cleaned.setdefault("source", "unknown")
+    return cleaned
+
+
+def splitter(docs: Iterable[Document], chunk_size=500, chunk_overlap=100) -> Iterator[Document]:
+    """
+    Splits one document at a time and yields the chunks, so the corpus is never joined
+    into a single string. Each chunk keeps its document's metadata (source, page,
+    index, collection, ...) plus the `start_index` of the chunk within that document.
+    """
     if not docs:
-        return []
-    
-    
-    combined_text = "\n".join(doc.page_content for doc in docs)
-    docs = [Document(page_content=combined_text)]  
-    
+        return
 
     splitters = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap
+        chunk_overlap=chunk_overlap,
+        add_start_index=True
     )
-    return splitters.split_documents(docs)
+    for doc in docs:
+        doc.metadata = _clean_metadata(doc.metadata)
+        yield from splitters.split_documents([doc])
 
 
-def embedings_store(docs, client, collection_name=None):
-    if collection_name is None:
-        collection_name = f"collection_{uuid.uuid4().hex[:8]}"
+def _batched(items, batch_size):
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
 
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
+def chunk_id(text: str, source: str, doc_id: str = None) -> str:
+    """Content-derived chunk id, stable across uploads of the same source."""
+    digest = hashlib.sha256(f"{source}\x00{text}".encode("utf-8")).hexdigest()[:32]
+    return f"{doc_id}:{digest}" if doc_id else digest
 
-    ids, metadatas, contents = [], [], []
-    for idx, doc in enumerate(docs):
-        ids.append(str(idx))
-        
-       
-        metadata = doc.metadata if doc.metadata else {"source": "unknown"}
-        metadatas.append(metadata)
-        
-        contents.append(doc.page_content)
 
+def embedings_store(
+    docs,
+    client,
+    collection_name=None,
+    doc_id=None,
+    progress=None,
+    batch_size=None,
+    start_batch=0,
+    on_batch=None,
+    incremental=False
+):
+    """
+    Embeds `docs` and upserts them into `collection_name` (a fresh collection when omitted)
+    of `client`, a VectorStore (see utils.vectorstore) or a Chroma client.
+    When `doc_id` is given the chunks are tagged with it, so several uploads can share
+    one collection and be told apart with a `where` filter.
+
+    Chunks are embedded `batch_size` at a time and every batch is upserted as soon as it
+    is ready, on a writer thread, while the next batch is being embedded. The writer also
+    keeps the lexical index (utils.lexical) in step with the collection. After each
+    upsert `on_batch(batch_index)` is called, and a later call with
+    `start_batch=batch_index + 1` skips the batches that are already stored.
+    `progress(processed, total)` is called as chunks are stored.
+
+    Chunk ids are derived from the source and text (see `chunk_id`). With `incremental`
+    the chunks already stored for this document are left alone, only new or changed
+    chunks are embedded and written, and chunks of the re-ingested sources that no
+    longer exist are deleted.
+    """
+    if collection_name is None:
+        collection_name = f"collection_{uuid.uuid4().hex[:8]}"
+    batch_size = batch_size or getattr(settings, "INGEST_BATCH_SIZE", 256)
+
+    vectorstore = as_vector_store(client).collection(collection_name)
+
+    lexical_index = get_lexical_index()
+    stored = vectorstore.stored(doc_id) if incremental else {}
+    seen_ids, seen_sources = set(), set()
+
+    total = len(docs) if hasattr(docs, "__len__") else None
+    processed = 0
+    if progress:
+        progress(0, total)
+
+    def upsert(batch_index, ids, vectors, metadatas, contents):
+        if ids:
+            vectorstore.upsert(ids, vectors, metadatas, contents)
+            if lexical_index is not None:
+                lexical_index.add(collection_name, ids, contents, metadatas)
+            # readers in other processes see the new chunks from here on
+            bump_collection_version(collection_name)
+        return batch_index
+
+    def commit(future, count):
+        nonlocal processed
+        batch_index = future.result()
+        processed += count
+        if on_batch:
+            on_batch(batch_index)
+        if progress:
+            progress(processed, total)
+
+    writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chroma-upsert")
+    pending = None
     try:
-        vectors = embeddings.embed_documents(contents) 
-    except Exception as e:
-        raise RuntimeError(f"Embedding failed: {e}")
+        for batch_index, batch in enumerate(_batched(docs, batch_size)):
+            ids, metadatas, contents = [], [], []
+            for doc in batch:
+                metadata = dict(doc.metadata) if doc.metadata else {}
+                metadata.setdefault("source", "unknown")
+                if doc_id:
+                    metadata["doc_id"] = doc_id
+
+                id_ = chunk_id(doc.page_content, metadata["source"], doc_id)
+                seen_sources.add(metadata["source"])
+                # identical chunks within a source collapse into one
+                if id_ in seen_ids:
+                    continue
+                seen_ids.add(id_)
+                if batch_index < start_batch or id_ in stored:
+                    continue
+
+                ids.append(id_)
+                metadatas.append(metadata)
+                contents.append(doc.page_content)
+
+            if batch_index < start_batch:
+                processed += len(batch)
+                continue
+
+            try:
+                vectors = embed_documents_cached(contents) if contents else []
+            except Exception as e:
+                raise RuntimeError(f"Embedding failed: {e}")
+
+            # the previous batch was being written while this one was embedded
+            if pending is not None:
+                commit(*pending)
+            pending = (writer.submit(upsert, batch_index, ids, vectors, metadatas, contents), len(batch))
+
+        if pending is not None:
+            commit(*pending)
+    finally:
+        writer.shutdown(wait=True)
+        bump_collection_version(collection_name)
+
+    if incremental:
+        stale = [id_ for id_, source in stored.items() if source in seen_sources and id_ not in seen_ids]
+        for start in range(0, len(stale), batch_size):
+            vectorstore.delete(stale[start:start + batch_size])
+        if lexical_index is not None and stale:
+            lexical_index.delete(collection_name, stale)
+        bump_collection_version(collection_name)
+        print(
+            f"Incremental ingest into {collection_name}: {len(seen_ids - stored.keys())} new, "
+            f"{len(seen_ids & stored.keys())} unchanged, {len(stale)} deleted"
+        )
 
-    vectorstore = Chroma(
-        client=client,
-        collection_name=collection_name,
-        embedding_function=None  
-    )
+    return collection_name
 
-    vectorstore._collection.upsert(
-        ids=ids,
-        embeddings=vectors,
-        metadatas=metadatas,
-        documents=contents
-    )
 
-    return collection_name
+def new_doc_id():
+    """Allocates the id an upload will be recorded under in User.docs."""
+    if vector_layout() == "per_user":
+        return f"doc_{uuid.uuid4().hex[:8]}"
+    return f"collection_{uuid.uuid4().hex[:8]}"
+
+
+def store_user_docs(docs, client, user_id, doc_id=None, **store_kwargs):
+    """
+    Stores an upload following settings.VECTOR_LAYOUT and returns the id to record in User.docs:
+    the new collection name for "per_upload", or the document id within the user's
+    collection for "per_user".
+    """
+    doc_id = doc_id or new_doc_id()
+    if vector_layout() == "per_user":
+        embedings_store(docs, client, user_collection_name(user_id), doc_id=doc_id, **store_kwargs)
+    else:
+        embedings_store(docs, client, doc_id, **store_kwargs)
+    return doc_id
 
 
 
@@ -0,0 +1,495 @@
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from langchain_core.documents import Document
+
+from utils.quantization import make_codec, unit_rows
+from utils.vectorstore import VectorCollection, VectorStore
+
+_NAME = re.compile(r"[\w\-]+")
+
+
+def _where_doc_ids(where):
+    """The doc ids selected by a `where` filter; only {"doc_id": x} and {"doc_id": {"$in": [...]}} exist."""
+    if not where:
+        return None
+    condition = where.get("doc_id")
+    if isinstance(condition, dict):
+        return list(condition.get("$in", []))
+    if condition is None:
+        raise ValueError(f"Unsupported filter for the local vector store: {where}")
+    return [condition]
+
+
+def kmeans(vectors, n_clusters, iterations=10, seed=0):
+    """Spherical k-means on unit vectors; returns unit centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(n_clusters):
+            members = vectors[assignment == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+            else:
+                # re-seed empty clusters
+                centroids[cluster] = vectors[rng.integers(len(vectors))]
+        centroids = unit_rows(centroids)
+    return centroids
+
+
+class LocalCollection(VectorCollection):
+    """
+    A collection kept on local disk: the vectors in a memory-mapped file, ids, documents
+    and metadata in SQLite, and an IVF index of `nlist` k-means centroids of which the
+    `nprobe` nearest lists are searched. Below `nlist * 39` vectors, or with nlist 0,
+    every vector is scanned.
+
+    `encoding` picks how vectors are stored and scanned (see utils.quantization). For
+    anything but float32, `rescore` also keeps the float32 vectors in a second file that
+    is only read for the `rescore_factor * k` best candidates, which are then ranked
+    by their exact similarity.
+
+    Vectors are normalized, distances are 1 - cosine similarity. Writes from several
+    processes are serialized by SQLite; readers reload when the collection's version
+    changes.
+    """
+
+    metric = "cosine"
+
+    def __init__(self, path, name, encoding=None, rescore=True, rescore_factor=4, nlist=256, nprobe=16):
+        self.name = name
+        self.path = path
+        self.codec = make_codec(encoding)
+        self.rescore = rescore and not self.codec.exact
+        self.rescore_factor = rescore_factor
+        self.nlist = nlist
+        self.nprobe = nprobe
+        if self.codec.trainable and not self.rescore:
+            # refitting re-encodes every vector from the full-precision copy
+            raise ValueError(f"The {encoding} encoding needs rescoring enabled")
+        self._lock = threading.RLock()
+        self._conn = None
+        self._version = None
+        self._codes = None
+        self._full = None
+        self._centroids = None
+        self._slots = np.empty(0, dtype=np.int64)
+        self._docs = np.empty(0, dtype=np.int32)
+        self._lists = np.empty(0, dtype=np.int32)
+        self._scales = np.empty(0, dtype=np.float32)
+        self._doc_codes = {}
+
+    # storage
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(self.path, exist_ok=True)
+            conn = sqlite3.connect(
+                os.path.join(self.path, "rows.sqlite3"), check_same_thread=False, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rows ("
+                " slot INTEGER PRIMARY KEY,"
+                " id TEXT NOT NULL UNIQUE,"
+                " doc_id TEXT,"
+                " source TEXT,"
+                " list INTEGER NOT NULL,"
+                " scale REAL NOT NULL,"
+                " document TEXT,"
+                " metadata TEXT)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+            encoding = conn.execute("SELECT value FROM meta WHERE key = 'encoding'").fetchone()
+            if encoding is None:
+                conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('encoding', ?)", (self.codec.name,))
+            elif encoding[0] != self.codec.name:
+                conn.close()
+                raise ValueError(f"{self.name} was created with the {encoding[0]} encoding, not {self.codec.name}")
+            self._conn = conn
+        return self._conn
+
+    def _meta(self, key, default=None):
+        row = self._db().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self._db().execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _open_vectors(self):
+        dim, capacity = self._meta("dim"), self._meta("capacity", 0)
+        if not dim or not capacity:
+            return None, None
+        codes = np.memmap(
+            self._file(f"vectors.{self.codec.name}"),
+            dtype=self.codec.dtype,
+            mode="r+",
+            shape=(capacity, self.codec.code_size(dim))
+        )
+        full = None
+        if self.rescore:
+            full = np.memmap(self._file("full.f32"), dtype=np.float32, mode="r+", shape=(capacity, dim))
+        return codes, full
+
+    def _ensure_capacity(self, dim, needed):
+        capacity = self._meta("capacity", 0)
+        if self._meta("dim") is None:
+            self._set_meta("dim", dim)
+        elif self._meta("dim") != dim:
+            raise ValueError(f"{self.name} stores {self._meta('dim')}-dimensional vectors, got {dim}")
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, 1024)
+        files = [(f"vectors.{self.codec.name}", self.codec.code_size(dim) * np.dtype(self.codec.dtype).itemsize)]
+        if self.rescore:
+            files.append(("full.f32", dim * 4))
+        for name, row_bytes in files:
+            with open(self._file(name), "ab") as f:
+                f.truncate(capacity * row_bytes)
+        self._set_meta("capacity", capacity)
+        self._codes, self._full = self._open_vectors()
+
+    @contextmanager
+    def _write(self):
+        """One write transaction; SQLite's lock keeps other processes out meanwhile."""
+        with self._lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._refresh()
+                yield conn
+                for vectors in (self._codes, self._full):
+                    if vectors is not None:
+                        vectors.flush()
+                self._version = self._meta("version", 0) + 1
+                self._set_meta("version", self._version)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                self._version = None  # reload from disk on the next access
+                raise
+
+    def _refresh(self):
+        """Reloads the in-memory row arrays if another process (or a rollback) changed the collection."""
+        version = self._meta("version", 0)
+        if version == self._version:
+            return
+        rows = self._db().execute("SELECT slot, doc_id, list, scale FROM rows ORDER BY slot").fetchall()
+        self._doc_codes = {}
+        self._slots = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        self._docs = np.fromiter((self._doc_code(row[1]) for row in rows), dtype=np.int32, count=len(rows))
+        self._lists = np.fromiter((row[2] for row in rows), dtype=np.int32, count=len(rows))
+        self._scales = np.fromiter((row[3] for row in rows), dtype=np.float32, count=len(rows))
+        self._codes, self._full = self._open_vectors()
+        self._centroids = np.load(self._file("centroids.npy")) if os.path.exists(self._file("centroids.npy")) else None
+        if os.path.exists(self._file("codec.npz")):
+            with np.load(self._file("codec.npz")) as state:
+                self.codec.load_state(dict(state))
+        self._version = version
+
+    def _doc_code(self, doc_id):
+        return self._doc_codes.setdefault(doc_id, len(self._doc_codes))
+
+    def _vectors_at(self, positions):
+        """Full-precision vectors of the rows at `positions`, or the best the codes give back."""
+        slots = self._slots[positions]
+        if self._full is not None:
+            return np.asarray(self._full[slots], dtype=np.float32)
+        return self.codec.decode(np.asarray(self._codes[slots]), self._scales[positions], self._meta("dim"))
+
+    def _new_slots(self, count):
+        """
+        Slots for `count` new rows: the holes deleted and replaced rows left behind first,
+        then fresh ones past the end, so the vector files only grow with the live rows.
+        """
+        capacity = self._meta("capacity", 0)
+        holes = np.setdiff1d(np.arange(capacity, dtype=np.int64), self._slots, assume_unique=True)[:count]
+        fresh = np.arange(capacity, capacity + count - len(holes), dtype=np.int64)
+        return np.concatenate([holes, fresh])
+
+    def _drop_rows(self, conn, ids):
+        removed = []
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            removed += [row[0] for row in conn.execute(
+                f"SELECT slot FROM rows WHERE id IN ({placeholders})", batch
+            )]
+            conn.execute(f"DELETE FROM rows WHERE id IN ({placeholders})", batch)
+        if removed:
+            keep = ~np.isin(self._slots, removed)
+            self._slots, self._docs = self._slots[keep], self._docs[keep]
+            self._lists, self._scales = self._lists[keep], self._scales[keep]
+
+    # VectorCollection
+
+    def upsert(self, ids, vectors, metadatas, documents):
+        if not ids:
+            return
+        vectors = unit_rows(vectors)
+
+        with self._write() as conn:
+            self._drop_rows(conn, list(ids))
+            if self.codec.fitted:
+                codes, scales = self.codec.encode(vectors)
+            else:
+                # nothing to encode with yet, searches read the full vectors until it is fitted
+                codes, scales = None, np.ones(len(ids), dtype=np.float32)
+            lists = (
+                np.argmax(vectors @ self._centroids.T, axis=1).astype(np.int32)
+                if self._centroids is not None else np.full(len(ids), -1, dtype=np.int32)
+            )
+            slots = self._new_slots(len(ids))
+            conn.executemany(
+                "INSERT INTO rows (slot, id, doc_id, source, list, scale, document, metadata)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (int(slot), id_, metadata.get("doc_id"), metadata.get("source"),
+                     int(list_), float(scale), document, json.dumps(metadata))
+                    for slot, id_, metadata, document, list_, scale
+                    in zip(slots, ids, metadatas, documents, lists, scales)
+                ]
+            )
+            self._ensure_capacity(vectors.shape[1], int(slots.max()) + 1)
+            if codes is not None:
+                self._codes[slots] = codes
+            if self._full is not None:
+                self._full[slots] = vectors
+
+            self._slots = np.concatenate([self._slots, slots])
+            self._docs = np.concatenate([
+                self._docs,
+                np.fromiter((self._doc_code(m.get("doc_id")) for m in metadatas), dtype=np.int32, count=len(ids))
+            ])
+            self._lists = np.concatenate([self._lists, lists])
+            self._scales = np.concatenate([self._scales, scales])
+            # reused slots land in the middle; the arrays stay in slot order, as _refresh loads them
+            order = np.argsort(self._slots, kind="stable")
+            self._slots, self._docs = self._slots[order], self._docs[order]
+            self._lists, self._scales = self._lists[order], self._scales[order]
+
+            count = len(self._slots)
+            if self.codec.trainable and count >= self.codec.min_fit_size and count >= 4 * self._meta("codec_count", 0):
+                self._fit_codec(conn)
+            if self.nlist and count >= self.nlist * 39 and count >= 4 * self._meta("ivf_count", 0):
+                self._train_ivf(conn)
+
+    def _sample(self, size):
+        positions = np.random.default_rng(0).choice(len(self._slots), min(len(self._slots), size), replace=False)
+        return self._vectors_at(np.sort(positions))
+
+    def _fit_codec(self, conn):
+        """(Re)fits a trainable encoding, e.g. PCA, and re-encodes every vector."""
+        self.codec.fit(self._sample(self.codec.min_fit_size * 4))
+        for start in range(0, len(self._slots), 65536):
+            positions = np.arange(start, min(start + 65536, len(self._slots)))
+            codes, scales = self.codec.encode(self._vectors_at(positions))
+            self._codes[self._slots[positions]] = codes
+            self._scales[positions] = scales
+        conn.executemany(
+            "UPDATE rows SET scale = ? WHERE slot = ?",
+            zip(self._scales.tolist(), self._slots.tolist())
+        )
+        np.savez(self._file("codec.npz"), **self.codec.state())
+        self._set_meta("codec_count", len(self._slots))
+
+    def _train_ivf(self, conn):
+        """(Re)builds the IVF centroids from a sample and reassigns every vector."""
+        self._centroids = kmeans(unit_rows(self._sample(self.nlist * 256)), self.nlist)
+        for start in range(0, len(self._slots), 65536):
+            positions = np.arange(start, min(start + 65536, len(self._slots)))
+            self._lists[positions] = np.argmax(self._vectors_at(positions) @ self._centroids.T, axis=1)
+        conn.executemany(
+            "UPDATE rows SET list = ? WHERE slot = ?",
+            zip(self._lists.tolist(), self._slots.tolist())
+        )
+        np.save(self._file("centroids.npy"), self._centroids)
+        self._set_meta("ivf_count", len(self._slots))
+
+    def delete(self, ids):
+        if ids:
+            with self._write() as conn:
+                self._drop_rows(conn, list(ids))
+
+    def stored(self, doc_id=None) -> dict:
+        with self._lock:
+            if doc_id:
+                rows = self._db().execute("SELECT id, source FROM rows WHERE doc_id = ?", (doc_id,))
+            else:
+                rows = self._db().execute("SELECT id, source FROM rows")
+            return {id_: source or "unknown" for id_, source in rows}
+
+    def iterate(self, batch_size=500, include_vectors=False):
+        last = -1
+        while True:
+            with self._lock:
+                self._refresh()
+                rows = self._db().execute(
+                    "SELECT slot, id, document, metadata FROM rows WHERE slot > ? ORDER BY slot LIMIT ?",
+                    (last, batch_size)
+                ).fetchall()
+                if not rows:
+                    return
+                vectors = None
+                if include_vectors:
+                    # _slots is kept in slot order
+                    positions = np.searchsorted(self._slots, [row[0] for row in rows])
+                    vectors = self._vectors_at(positions)
+            last = rows[-1][0]
+            yield (
+                [row[1] for row in rows],
+                vectors,
+                [json.loads(row[3]) for row in rows],
+                [row[2] or "" for row in rows],
+            )
+
+    def _top(self, scores, k):
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        return top[np.argsort(-scores[top], kind="stable")]
+
+    def _score(self, query, candidates, k):
+        """Returns (positions, similarities) of the best `k` candidates, best first."""
+        if not self.codec.fitted:
+            scores = self._vectors_at(candidates) @ query
+            top = self._top(scores, k)
+            return candidates[top], scores[top]
+
+        scores = self.codec.similarity(
+            self.codec.prepare_query(query),
+            self._codes[self._slots[candidates]],
+            self._scales[candidates]
+        )
+        if self._full is None:
+            top = self._top(scores, k)
+            return candidates[top], scores[top]
+
+        # the approximate scores only pick the shortlist, the exact ones rank it
+        shortlist = candidates[self._top(scores, k * self.rescore_factor)]
+        exact = self._vectors_at(shortlist) @ query
+        top = self._top(exact, k)
+        return shortlist[top], exact[top]
+
+    def search(self, query_vector, k, where=None) -> list:
+        if k <= 0 or not os.path.isdir(self.path):
+            return []
+        query = unit_rows([query_vector])[0]
+
+        with self._lock:
+            self._refresh()
+            if not len(self._slots):
+                return []
+
+            mask = np.ones(len(self._slots), dtype=bool)
+            doc_ids = _where_doc_ids(where)
+            if doc_ids is not None:
+                codes = [self._doc_codes[doc_id] for doc_id in doc_ids if doc_id in self._doc_codes]
+                mask &= np.isin(self._docs, codes)
+
+            candidates = np.flatnonzero(mask)
+            if self._centroids is not None and self.nprobe < len(self._centroids):
+                probes = np.argpartition(-(self._centroids @ query), self.nprobe - 1)[:self.nprobe]
+                probed = candidates[np.isin(self._lists[candidates], probes)]
+                # a narrow filter can leave the probed lists short, then scan what it allows
+                candidates = probed if len(probed) >= k else candidates
+            if not len(candidates):
+                return []
+
+            positions, scores = self._score(query, candidates, k)
+            slots = self._slots[positions].tolist()
+
+            placeholders = ",".join("?" * len(slots))
+            rows = {
+                slot: (id_, doc_id, document, metadata)
+                for slot, id_, doc_id, document, metadata in self._db().execute(
+                    f"SELECT slot, id, doc_id, document, metadata FROM rows WHERE slot IN ({placeholders})", slots
+                )
+            }
+
+        results = []
+        for slot, score in zip(slots, scores.tolist()):
+            # another process may have deleted the row or reused its slot since the refresh
+            if slot not in rows or (doc_ids is not None and rows[slot][1] not in doc_ids):
+                continue
+            id_, _, document, metadata = rows[slot]
+            results.append((Document(id=id_, page_content=document or "", metadata=json.loads(metadata)), 1.0 - score))
+        return results
+
+    def memory_usage(self) -> dict:
+        """Bytes per stored vector: scanned on every query, and read only when rescoring."""
+        dim = self._meta("dim") or 0
+        scanned = self.codec.code_size(dim) * np.dtype(self.codec.dtype).itemsize
+        if self.codec.scaled:
+            scanned += 4
+        return {"scanned_bytes": scanned, "rescore_bytes": dim * 4 if self._full is not None else 0}
+
+
+class LocalVectorStore(VectorStore):
+    def __init__(self, path, encoding=None, rescore=True, rescore_factor=4, nlist=256, nprobe=16):
+        self.path = path
+        self.options = {
+            "encoding": encoding,
+            "rescore": rescore,
+            "rescore_factor": rescore_factor,
+            "nlist": nlist,
+            "nprobe": nprobe,
+        }
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def _collection_path(self, name):
+        if not _NAME.fullmatch(name):
+            raise ValueError(f"Invalid collection name: {name!r}")
+        return os.path.join(self.path, name)
+
+    def collection(self, name) -> LocalCollection:
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = LocalCollection(
+                    self._collection_path(name), name, **self.options
+                )
+            return collection
+
+    def has_collection(self, name) -> bool:
+        return os.path.exists(os.path.join(self._collection_path(name), "rows.sqlite3"))
+
+    def list_collections(self) -> list:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path) if _NAME.fullmatch(name) and self.has_collection(name))
+
+    def delete_collection(self, name):
+        with self._lock:
+            self._collections.pop(name, None)
+        shutil.rmtree(self._collection_path(name), ignore_errors=True)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_local_store() -> LocalVectorStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = LocalVectorStore(
+                    settings.LOCAL_VECTOR_PATH,
+                    encoding=getattr(settings, "LOCAL_VECTOR_ENCODING", "float32"),
+                    rescore=getattr(settings, "LOCAL_VECTOR_RESCORE", True),
+                    rescore_factor=getattr(settings, "LOCAL_VECTOR_RESCORE_FACTOR", 4),
+                    nlist=getattr(settings, "LOCAL_VECTOR_NLIST", 256),
+                    nprobe=getattr(settings, "LOCAL_VECTOR_NPROBE", 16),
+                )
+    return _store
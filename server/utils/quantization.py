@@ -0,0 +1,203 @@
+import numpy as np
+
+
+def unit_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(values):
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(values)
+    return _POPCOUNT[values]
+
+
+class VectorCodec:
+    """
+    How a collection stores its unit vectors: `encode` turns them into compact codes
+    (plus one float per vector, for codecs that need a scale) and `similarity`
+    estimates the cosine similarity of a prepared query with stored codes.
+    Trainable codecs have to `fit` a sample before they can encode.
+    """
+
+    name = None
+    dtype = np.float32
+    exact = False
+    scaled = False
+    trainable = False
+    min_fit_size = 0
+
+    def code_size(self, dim: int) -> int:
+        return dim
+
+    def fit(self, vectors):
+        pass
+
+    @property
+    def fitted(self) -> bool:
+        return True
+
+    def encode(self, vectors):
+        return vectors.astype(self.dtype), np.ones(len(vectors), dtype=np.float32)
+
+    def decode(self, codes, scales, dim: int):
+        """Approximate unit vectors back in the full space."""
+        return unit_rows(codes)
+
+    def prepare_query(self, query):
+        return query
+
+    def similarity(self, query, codes, scales):
+        return np.asarray(codes, dtype=np.float32) @ query
+
+    def state(self) -> dict:
+        return {}
+
+    def load_state(self, state: dict):
+        pass
+
+
+class Float32Codec(VectorCodec):
+    name = "f32"
+    exact = True
+
+
+class Int8Codec(VectorCodec):
+    """Every vector scaled to [-127, 127]; a quarter of the bytes of float32."""
+
+    name = "i8"
+    dtype = np.int8
+    scaled = True
+
+    def encode(self, vectors):
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def decode(self, codes, scales, dim):
+        return unit_rows(np.asarray(codes, dtype=np.float32) * scales[:, None])
+
+    def similarity(self, query, codes, scales):
+        return (np.asarray(codes, dtype=np.float32) @ query) * scales
+
+
+class BinaryCodec(VectorCodec):
+    """
+    One sign bit per dimension, 1/32 of float32. Similarity comes from the Hamming
+    distance h as cos(pi * h / dim), the expected cosine for random hyperplanes.
+    """
+
+    name = "bin"
+    dtype = np.uint8
+
+    def code_size(self, dim):
+        return (dim + 7) // 8
+
+    def encode(self, vectors):
+        return np.packbits(vectors > 0, axis=1), np.ones(len(vectors), dtype=np.float32)
+
+    def decode(self, codes, scales, dim):
+        signs = np.unpackbits(np.asarray(codes), axis=1, count=dim).astype(np.float32) * 2 - 1
+        return unit_rows(signs)
+
+    def prepare_query(self, query):
+        return np.packbits(query > 0), len(query)
+
+    def similarity(self, query, codes, scales):
+        bits, dim = query
+        distance = _popcount(np.bitwise_xor(np.asarray(codes), bits)).sum(axis=1, dtype=np.int32)
+        return np.cos(np.pi * distance / dim).astype(np.float32)
+
+
+class TruncateCodec(VectorCodec):
+    """
+    Matryoshka truncation: the first `dim` dimensions, renormalized. Only models trained
+    with a Matryoshka loss keep their quality this way; the benchmark command shows how
+    much the configured model loses.
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.name = f"mrl{dim}"
+
+    def code_size(self, dim):
+        return min(self.dim, dim)
+
+    def encode(self, vectors):
+        return unit_rows(vectors[:, :self.dim]), np.ones(len(vectors), dtype=np.float32)
+
+    def decode(self, codes, scales, dim):
+        full = np.zeros((len(codes), dim), dtype=np.float32)
+        full[:, :codes.shape[1]] = codes
+        return full
+
+    def prepare_query(self, query):
+        return unit_rows([query[:self.dim]])[0]
+
+
+class PCACodec(VectorCodec):
+    """Projection onto the top `dim` principal components of the collection, renormalized."""
+
+    trainable = True
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.name = f"pca{dim}"
+        self.min_fit_size = max(1024, 4 * dim)
+        self._mean = None
+        self._components = None
+
+    @property
+    def fitted(self):
+        return self._components is not None
+
+    def code_size(self, dim):
+        return min(self.dim, dim)
+
+    def fit(self, vectors):
+        self._mean = vectors.mean(axis=0)
+        # right singular vectors of the centred sample are the principal axes
+        _, _, axes = np.linalg.svd(vectors - self._mean, full_matrices=False)
+        self._components = axes[:self.dim].astype(np.float32)
+
+    def _project(self, vectors):
+        return unit_rows((vectors - self._mean) @ self._components.T)
+
+    def encode(self, vectors):
+        return self._project(vectors), np.ones(len(vectors), dtype=np.float32)
+
+    def decode(self, codes, scales, dim):
+        return unit_rows(np.asarray(codes) @ self._components + self._mean)
+
+    def prepare_query(self, query):
+        return self._project(query[None, :])[0]
+
+    def state(self):
+        return {"mean": self._mean, "components": self._components} if self.fitted else {}
+
+    def load_state(self, state):
+        if "components" in state:
+            self._mean = state["mean"]
+            self._components = state["components"]
+
+
+def make_codec(encoding: str = None) -> VectorCodec:
+    """`float32` (default), `int8`, `binary`, `matryoshka:<dims>` or `pca:<dims>`."""
+    encoding = (encoding or "float32").lower()
+    kind, _, size = encoding.partition(":")
+    if kind == "float32":
+        return Float32Codec()
+    if kind == "int8":
+        return Int8Codec()
+    if kind == "binary":
+        return BinaryCodec()
+    if kind == "matryoshka" and size.isdigit():
+        return TruncateCodec(int(size))
+    if kind == "pca" and size.isdigit():
+        return PCACodec(int(size))
+    raise ValueError(f"Unknown vector encoding: {encoding}")
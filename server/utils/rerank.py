@@ -0,0 +1,152 @@
+import asyncio
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.conf import settings
+
+from utils.cache import TTLCache, normalize_query
+from utils.embedding_cache import text_hash
+
+
+def _chunk_id(doc):
+    return getattr(doc, "id", None) or text_hash(doc.page_content)
+
+
+class CrossEncoderReranker:
+    """
+    Re-orders retrieved chunks with a small cross-encoder run on the CPU. Scores are
+    cached per (query, chunk id). Scoring runs on a dedicated thread and the caller
+    waits at most `budget` seconds; past that the vector ordering is kept. The scorer
+    checks the same deadline before every batch, so work nobody waits for any more
+    (including requests queued behind a busy scorer) stops instead of delaying the next
+    ones; the batches it did finish are cached for the next time the question comes up.
+    """
+
+    def __init__(self, model_name, batch_size=16, budget=0.3, cache_size=10_000, cache_ttl=3600, device="cpu"):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.budget = budget
+        self.device = device
+        self.reranked = 0
+        self.timeouts = 0
+        self._model = None
+        self._lock = threading.Lock()
+        self._scores = TTLCache(max_entries=cache_size, ttl=cache_ttl)
+        # one scorer: the model already uses every core for a batch
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+
+    def _load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_name, device=self.device)
+        return self._model
+
+    def warm_up(self):
+        self._load().predict([("warm up", "warm up")], show_progress_bar=False)
+
+    def _score(self, query, docs, deadline) -> dict:
+        """Scores of `docs`, or None when `deadline` (time.monotonic) passed first."""
+        key = normalize_query(query)
+        scores, missing = {}, []
+        for doc in docs:
+            score = self._scores.get((key, _chunk_id(doc)))
+            if score is None:
+                missing.append(doc)
+            else:
+                scores[_chunk_id(doc)] = score
+
+        model = self._load() if missing else None
+        for start in range(0, len(missing), self.batch_size):
+            if time.monotonic() >= deadline:
+                return None
+            batch = missing[start:start + self.batch_size]
+            logits = model.predict([(query, doc.page_content) for doc in batch], show_progress_bar=False)
+            for doc, logit in zip(batch, logits):
+                score = 1.0 / (1.0 + math.exp(-float(logit)))
+                self._scores.set((key, _chunk_id(doc)), score)
+                scores[_chunk_id(doc)] = score
+        return scores
+
+    def _order(self, docs, scores, top_n):
+        """Copies of the `top_n` best docs, with the cross-encoder score as their relevance."""
+        self.reranked += 1
+        ranked = sorted(docs, key=lambda doc: scores[_chunk_id(doc)], reverse=True)[:top_n]
+        return [
+            type(doc)(
+                id=getattr(doc, "id", None),
+                page_content=doc.page_content,
+                metadata={
+                    **doc.metadata,
+                    "vector_relevance": doc.metadata.get("relevance"),
+                    "relevance": scores[_chunk_id(doc)],
+                }
+            )
+            for doc in ranked
+        ]
+
+    def _fallback(self, docs, top_n):
+        self.timeouts += 1
+        return list(docs[:top_n])
+
+    def rerank(self, query: str, docs, top_n: int):
+        """Returns the `top_n` best of `docs`, or the first `top_n` if the budget runs out."""
+        if len(docs) <= 1:
+            return list(docs[:top_n])
+        future = self._pool.submit(self._score, query, docs, time.monotonic() + self.budget)
+        try:
+            scores = future.result(timeout=self.budget)
+        except TimeoutError:
+            future.cancel()  # drops it if still queued, the deadline stops it once running
+            return self._fallback(docs, top_n)
+        if scores is None:
+            return self._fallback(docs, top_n)
+        return self._order(docs, scores, top_n)
+
+    async def arerank(self, query: str, docs, top_n: int):
+        """Same as `rerank`, awaiting the scorer instead of blocking on it."""
+        if len(docs) <= 1:
+            return list(docs[:top_n])
+        future = self._pool.submit(self._score, query, docs, time.monotonic() + self.budget)
+        try:
+            scores = await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.budget)
+        except asyncio.TimeoutError:
+            future.cancel()  # drops it if still queued, the deadline stops it once running
+            return self._fallback(docs, top_n)
+        if scores is None:
+            return self._fallback(docs, top_n)
+        return self._order(docs, scores, top_n)
+
+    def stats(self) -> dict:
+        return {
+            "model_name": self.model_name,
+            "reranked": self.reranked,
+            "timeouts": self.timeouts,
+            "score_cache": self._scores.stats(),
+        }
+
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker():
+    """The process-wide reranker, or None when RERANK_ENABLED is off."""
+    global _reranker
+    if not getattr(settings, "RERANK_ENABLED", False):
+        return None
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = CrossEncoderReranker(
+                    model_name=settings.RERANK_MODEL,
+                    batch_size=getattr(settings, "RERANK_BATCH_SIZE", 16),
+                    budget=getattr(settings, "RERANK_BUDGET_MS", 300) / 1000,
+                    cache_size=getattr(settings, "RERANK_CACHE_SIZE", 10_000),
+                    cache_ttl=getattr(settings, "RERANK_CACHE_TTL", 3600),
+                    device=getattr(settings, "EMBEDDING_DEVICE", "cpu"),
+                )
+    return _reranker
@@ -0,0 +1,54 @@
+import heapq
+
+import numpy as np
+
+
+# Chroma reports distances whose meaning depends on the collection's hnsw:space.
+# relevance = 1 - distance * scale maps each of them onto cosine similarity for
+# unit-length embeddings (all-mpnet-base-v2 normalizes its output):
+#   cosine: d = 1 - cos        ip: d = 1 - dot        l2: d = |a - b|^2 = 2 - 2cos
+DISTANCE_SCALES = {"cosine": 1.0, "ip": 1.0, "l2": 0.5}
+
+
+def collection_metric(collection) -> str:
+    metadata = getattr(collection, "metadata", None) or {}
+    return metadata.get("hnsw:space", "l2")
+
+
+def select_relevant(candidates, scales, threshold: float, k: int):
+    """
+    Picks the top `k` documents with relevance >= `threshold` from the candidates of
+    every collection in one vectorized pass.
+
+    `candidates` is a list of (Document, distance) and `scales` the distance scale of
+    the collection each candidate came from. Returns (Document, relevance) pairs,
+    most relevant first.
+    """
+    if not candidates or k <= 0:
+        return []
+
+    distances = np.fromiter((distance for _, distance in candidates), dtype=np.float32, count=len(candidates))
+    relevance = np.clip(1.0 - distances * np.asarray(scales, dtype=np.float32), 0.0, 1.0)
+
+    keep = np.flatnonzero(relevance >= threshold)
+    if keep.size > k:
+        keep = keep[np.argpartition(-relevance[keep], k - 1)[:k]]
+    keep = keep[np.argsort(-relevance[keep], kind="stable")]
+
+    return [(candidates[i][0], float(relevance[i])) for i in keep]
+
+
+def reciprocal_rank_fusion(rankings, k: int, key, rrf_k: int = 60):
+    """
+    Merges ranked lists of documents from different retrievers. Every document scores
+    sum(1 / (rrf_k + rank)) over the lists it appears in, `key(doc)` telling which
+    documents are the same. Returns the top `k` (Document, score) pairs, best first.
+    """
+    scores, docs = {}, {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            id_ = key(doc)
+            scores[id_] = scores.get(id_, 0.0) + 1.0 / (rrf_k + rank)
+            docs.setdefault(id_, doc)
+    best = heapq.nlargest(k, scores, key=scores.get) if k > 0 else []
+    return [(docs[id_], scores[id_]) for id_ in best]
@@ -0,0 +1,152 @@
+import threading
+
+from django.conf import settings
+from langchain_chroma import Chroma
+
+from utils.chroma import get_default_client
+from utils.retrieval import collection_metric
+
+
+class VectorCollection:
+    """
+    One collection of chunk vectors, as used by `embedings_store` and the retriever.
+    `metric` is the distance reported by `search` (see utils.retrieval.DISTANCE_SCALES).
+    """
+
+    name = None
+    metric = "cosine"
+
+    def upsert(self, ids, vectors, metadatas, documents):
+        raise NotImplementedError
+
+    def delete(self, ids):
+        raise NotImplementedError
+
+    def stored(self, doc_id=None) -> dict:
+        """Returns {chunk id: source} of everything stored, or only of document `doc_id`."""
+        raise NotImplementedError
+
+    def iterate(self, batch_size=500, include_vectors=False):
+        """
+        Yields everything stored as (ids, vectors, metadatas, documents) batches; vectors
+        is None unless `include_vectors`. Used by the maintenance commands.
+        """
+        raise NotImplementedError
+
+    def search(self, query_vector, k, where=None) -> list:
+        """Returns up to `k` (Document, distance) pairs, nearest first."""
+        raise NotImplementedError
+
+
+class VectorStore:
+    def collection(self, name) -> VectorCollection:
+        """The named collection, created empty if it does not exist."""
+        raise NotImplementedError
+
+    def has_collection(self, name) -> bool:
+        raise NotImplementedError
+
+    def list_collections(self) -> list:
+        raise NotImplementedError
+
+    def delete_collection(self, name):
+        raise NotImplementedError
+
+
+class ChromaCollection(VectorCollection):
+    def __init__(self, client, name):
+        self.name = name
+        self._store = Chroma(client=client, collection_name=name, embedding_function=None)
+        self.metric = collection_metric(self._store._collection)
+
+    def upsert(self, ids, vectors, metadatas, documents):
+        self._store._collection.upsert(ids=ids, embeddings=vectors, metadatas=metadatas, documents=documents)
+
+    def delete(self, ids):
+        self._store._collection.delete(ids=ids)
+
+    def stored(self, doc_id=None, page_size=1000) -> dict:
+        stored, offset = {}, 0
+        while True:
+            page = self._store._collection.get(
+                where={"doc_id": doc_id} if doc_id else None,
+                include=["metadatas"],
+                limit=page_size,
+                offset=offset
+            )
+            if not page["ids"]:
+                return stored
+            for id_, metadata in zip(page["ids"], page["metadatas"]):
+                stored[id_] = (metadata or {}).get("source", "unknown")
+            offset += len(page["ids"])
+
+    def iterate(self, batch_size=500, include_vectors=False):
+        include = ["documents", "metadatas", *(["embeddings"] if include_vectors else [])]
+        offset = 0
+        while True:
+            page = self._store._collection.get(include=include, limit=batch_size, offset=offset)
+            if not page["ids"]:
+                return
+            vectors = page["embeddings"] if include_vectors else None
+            yield page["ids"], vectors, [dict(m or {}) for m in page["metadatas"]], page["documents"]
+            offset += len(page["ids"])
+
+    def search(self, query_vector, k, where=None) -> list:
+        return self._store.similarity_search_by_vector_with_relevance_scores(query_vector, k=k, filter=where)
+
+
+class ChromaVectorStore(VectorStore):
+    def __init__(self, client):
+        self.client = client
+
+    def collection(self, name) -> ChromaCollection:
+        return ChromaCollection(self.client, name)
+
+    def has_collection(self, name) -> bool:
+        try:
+            self.client.get_collection(name)
+        except Exception:
+            return False
+        return True
+
+    def list_collections(self) -> list:
+        # names on newer chromadb versions, collections on older ones
+        return [getattr(c, "name", c) for c in self.client.list_collections()]
+
+    def delete_collection(self, name):
+        self.client.delete_collection(name)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def vector_backend():
+    return getattr(settings, "VECTOR_BACKEND", "chroma")
+
+
+def as_vector_store(client) -> VectorStore:
+    """Wraps a Chroma client; VectorStores are returned unchanged."""
+    if client is None or isinstance(client, VectorStore):
+        return client
+    with _stores_lock:
+        # keyed by the client, so a reconnected client gets a new store
+        store = _stores.get(id(client))
+        if store is None or store.client is not client:
+            store = _stores[id(client)] = ChromaVectorStore(client)
+        return store
+
+
+def get_vector_store():
+    """
+    The store selected by settings.VECTOR_BACKEND: Chroma through the pooled client, or
+    the on-disk index of utils.local_vectors. Returns None when Chroma is unreachable.
+    """
+    if vector_backend() == "local":
+        from utils.local_vectors import get_local_store
+        return get_local_store()
+    try:
+        return as_vector_store(get_default_client())
+    except Exception as e:
+        print(f" Error connecting to Chroma: {e}")
+        return None